@@ -0,0 +1,389 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''
+Palo Alto Networks bench_parse.py
+
+Microbenchmarks for the parse and enrichment hot paths
+
+Synthetic Autofocus hit pages are fed through the threat and session
+parse_sample_data, missing_samples, quick_stats, clean_exploit_data, and the
+pretty file build.
+Each case runs in its own process in a scratch directory so peak RSS is per
+case and no real data files are touched.
+
+Reports records per second, peak RSS, and bytes written, and stores the
+results as json for comparing runs across changes
+
+This software is provided without support, warranty, or guarantee.
+Use at your own risk.
+'''
+
+import argparse
+import sys
+import os
+import csv
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# adding shared dir for imports
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(here, '../shared')))
+
+# synthetic hits and tags matching the Autofocus response formats
+from mockaf import synthetic_sample_hit, synthetic_session_hit, synthetic_tag
+
+# local imports for static data input
+import conf
+
+cases = ['threat_parse', 'session_parse', 'threat_missing', 'session_missing', 'quick_stats', 'clean_exploits',
+         'pretty_build']
+
+# hits per results page, same as the scan searches
+page_size = 1000
+# synthetic tags written to the scratch tagdata.json
+tag_count = 3000
+query_tag = 'bench'
+
+
+def peak_rss_kb():
+
+    '''
+    :return: peak resident set size of this process in KB, None where not available
+    '''
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux KB
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+
+    return peak
+
+
+def hit_pages(maker, records):
+
+    '''
+    :param maker: synthetic_sample_hit or synthetic_session_hit
+    :param records: total hits
+    :return: list of results pages of up to page_size hits
+    '''
+
+    hits = [maker(f'bench-{n}', tag_count) for n in range(records)]
+
+    return [{'hits': hits[start:start + page_size]} for start in range(0, records, page_size)]
+
+
+def write_scratch_data(records):
+
+    '''
+    tag data and exploit csv in the scratch data dir
+    :param records: exploit csv rows
+    '''
+
+    os.mkdir('data')
+
+    tags = {}
+    for n in range(tag_count):
+        tag = synthetic_tag(n)
+        tags[tag['public_tag_name']] = tag
+    with open('data/tagdata.json', 'w') as tag_file:
+        json.dump({'_tags': tags}, tag_file)
+
+    conf.inputfile_exploits = 'bench_exploits.csv'
+    rng = random.Random(records)
+    with open(f'data/{conf.inputfile_exploits}', 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Threat Name', 'CVE', 'Category', 'Severity'])
+        for n in range(records):
+            cve = f'CVE-2017-{n % 12000}'
+            # some firewall sigs list several CVEs in one field
+            if n % 10 == 0:
+                cve = f'{cve},CVE-2018-{n % 12000}'
+            writer.writerow([f'Bench Exploit {n}', cve, rng.choice(['code-execution', 'overflow', 'info-leak']),
+                             rng.choice(['critical', 'high', 'medium'])])
+
+
+def output_bytes(*writers):
+
+    # path is the estack file and the pretty json lines intermediate
+    return sum(os.path.getsize(writer.path) for writer in writers)
+
+
+def setup_case(case, records, compression):
+
+    '''
+    build the inputs for one case before timing starts
+    :return: function taking no args that runs the case and returns bytes written
+    '''
+
+    import threat_data
+    import session_data
+    from tagindex import get_tag_index
+    from geocache import get_geo_cache
+    from estackwriter import EstackWriter
+    from prettywriter import PrettyWriter
+
+    conf.hashtype = 'sha256'
+    conf.get_exploits = True
+    conf.geo_offline = 'yes'
+    start_time = datetime.now()
+
+    write_scratch_data(records)
+    os.mkdir(conf.out_estack)
+    os.mkdir(conf.out_pretty)
+
+    # loaded up front so the timing is per record work only
+    get_tag_index()
+    get_geo_cache()
+
+    def writers(module):
+        estack_writer = EstackWriter(f'{conf.out_estack}/bench_estack.json', module.elk_index(),
+                                     compression=compression)
+        pretty_writer = PrettyWriter(f'{conf.out_pretty}/bench_pretty.json', 'samples', compression=compression)
+        return estack_writer, pretty_writer
+
+    if case == 'threat_parse':
+        pages = hit_pages(synthetic_sample_hit, records)
+        exploits = threat_data.clean_exploit_data()
+        estack_writer, pretty_writer = writers(threat_data)
+        found_hashes = set()
+
+        def run():
+            for page in pages:
+                threat_data.parse_sample_data(page, start_time, query_tag, pretty_writer, estack_writer, exploits,
+                                              found_hashes=found_hashes)
+            estack_writer.close()
+            pretty_writer.close(materialize=False)
+            return output_bytes(estack_writer, pretty_writer)
+
+    elif case == 'session_parse':
+        pages = hit_pages(synthetic_session_hit, records)
+        estack_writer, pretty_writer = writers(session_data)
+        found_hashes = set()
+
+        def run():
+            for page in pages:
+                session_data.parse_sample_data(page, start_time, query_tag, pretty_writer, None, estack_writer,
+                                               found_hashes=found_hashes)
+            estack_writer.close()
+            pretty_writer.close(materialize=False)
+            return output_bytes(estack_writer, pretty_writer)
+
+    elif case in ('threat_missing', 'session_missing'):
+        module = threat_data if case == 'threat_missing' else session_data
+        # every other input hash was found by the search
+        hash_list = [synthetic_sample_hit(f'bench-{n}', tag_count)['_id'] for n in range(records)]
+        found_hashes = set(hash_list[::2])
+        estack_writer, pretty_writer = writers(module)
+
+        def run():
+            module.missing_samples(query_tag, start_time, hash_list, found_hashes, estack_writer, pretty_writer)
+            estack_writer.close()
+            pretty_writer.close(materialize=False)
+            return output_bytes(estack_writer, pretty_writer)
+
+    elif case == 'quick_stats':
+        rng = random.Random(records)
+        samples = [{'hashvalue': f'{n:064x}',
+                    'verdict': rng.choice(['malware', 'malware', 'grayware', 'benign', 'phishing', 'No Sample Found']),
+                    'wf_av_sig_sig_state': rng.choice(['active', 'inactive', 'none'])}
+                   for n in range(records)]
+        with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json', 'w') as samples_file:
+            json.dump({'samples': samples}, samples_file, indent=2)
+        del samples
+
+        def run():
+            threat_data.quick_stats(query_tag)
+            return 0
+
+    elif case == 'pretty_build':
+        # parsed sample records in the json lines intermediate; only the pretty file build is timed
+        pages = hit_pages(synthetic_sample_hit, records)
+        exploits = threat_data.clean_exploit_data()
+        estack_writer, pretty_writer = writers(threat_data)
+        for page in pages:
+            threat_data.parse_sample_data(page, start_time, query_tag, pretty_writer, estack_writer, exploits)
+        estack_writer.close()
+        pretty_writer.flush()
+        del pages
+
+        def run():
+            pretty_writer.materialize()
+            return os.path.getsize(pretty_writer.filename)
+
+    elif case == 'clean_exploits':
+
+        def run():
+            threat_data.clean_exploit_data()
+            return 0
+
+    else:
+        print(f'unknown benchmark case {case}; use one of {", ".join(cases)}')
+        sys.exit(1)
+
+    return run
+
+
+def run_case(case, records, compression, json_backend):
+
+    '''
+    child process side: run one case in a scratch dir
+    :return: result dict
+    '''
+
+    from jsoncodec import get_backend
+
+    conf.json_backend = json_backend
+
+    with tempfile.TemporaryDirectory(prefix='bench_parse_') as scratch:
+        os.chdir(scratch)
+
+        # parse and missing sample code prints progress; kept out of the result line
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run = setup_case(case, records, compression)
+            setup_rss = peak_rss_kb()
+            start = time.perf_counter()
+            bytes_written = run()
+            seconds = time.perf_counter() - start
+
+        os.chdir(here)
+
+    return {'case': case,
+            'records': records,
+            'seconds': round(seconds, 4),
+            'records_per_sec': round(records / seconds, 1) if seconds > 0 else None,
+            'peak_rss_kb': peak_rss_kb(),
+            'setup_rss_kb': setup_rss,
+            'bytes_written': bytes_written,
+            'json_backend': get_backend(),
+            }
+
+
+def spawn_case(case, records, compression, json_backend):
+
+    '''
+    run one case in a fresh interpreter so peak RSS is for that case only
+    :return: result dict
+    '''
+
+    command = [sys.executable, os.path.abspath(__file__), '--child', case, str(records), '-z', compression,
+               '-j', json_backend]
+    completed = subprocess.run(command, capture_output=True, text=True)
+
+    if completed.returncode != 0:
+        print(completed.stdout)
+        print(completed.stderr)
+        print(f'\nbenchmark case {case} with {records} records failed\n')
+        sys.exit(1)
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_results(results, baseline=None):
+
+    '''
+    :param results: result dicts
+    :param baseline: earlier results file contents to compare records/sec against, or None
+    '''
+
+    previous = {}
+    if baseline is not None:
+        for result in baseline['results']:
+            previous[(result['case'], result['records'])] = result
+
+    print('=' * 80)
+    print(f"{'case':<18}{'records':>9}{'seconds':>10}{'records/sec':>14}{'peak MB':>10}{'MB written':>12}"
+          f"{'vs base':>9}")
+    print('-' * 80)
+    for result in results:
+        peak = f"{result['peak_rss_kb'] / 1024:.1f}" if result['peak_rss_kb'] is not None else '-'
+        ratio = '-'
+        base = previous.get((result['case'], result['records']))
+        if base is not None and base['records_per_sec'] and result['records_per_sec']:
+            ratio = f"{result['records_per_sec'] / base['records_per_sec']:.2f}x"
+        print(f"{result['case']:<18}{result['records']:>9}{result['seconds']:>10.3f}"
+              f"{result['records_per_sec'] or 0:>14.0f}{peak:>10}{result['bytes_written'] / 1048576:>12.1f}"
+              f"{ratio:>9}")
+    print('=' * 80)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--case", help=f"case to run, repeat for several: {', '.join(cases)}",
+                        type=str, action='append', choices=cases)
+    parser.add_argument("-s", "--sizes", help="record counts to run each case with", type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument("-n", "--repeat", help="runs per case and size; the fastest is kept", type=int, default=1)
+    parser.add_argument("-z", "--compression", help="output compression for the writers", type=str,
+                        default='none', choices=['none', 'gzip', 'zstd'])
+    parser.add_argument("-j", "--json_backend", help="json backend for the writers and readers", type=str,
+                        default='auto', choices=['auto', 'orjson', 'json'])
+    parser.add_argument("-o", "--output", help="results json file", type=str)
+    parser.add_argument("-b", "--baseline", help="earlier results json file to compare against", type=str)
+    parser.add_argument("--child", help=argparse.SUPPRESS, nargs=2)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child[0], int(args.child[1]), args.compression, args.json_backend)))
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+    run_time = datetime.now()
+    output = args.output or f'data/bench_parse_{run_time.strftime("%Y%m%d_%H%M%S")}.json'
+    results = []
+
+    for case in args.case or cases:
+        for records in args.sizes:
+            print(f'running {case} with {records} records')
+            runs = [spawn_case(case, records, args.compression, args.json_backend) for _ in range(max(args.repeat, 1))]
+            results.append(min(runs, key=lambda result: result['seconds']))
+
+    report = {'run_time': run_time.isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'compression': args.compression,
+              'json_backend': results[0]['json_backend'] if results else args.json_backend,
+              'page_size': page_size,
+              'results': results,
+              }
+
+    with open(output, 'w') as output_file:
+        output_file.write(json.dumps(report, indent=2) + "\n")
+
+    print_results(results, baseline)
+    print(f'results written to {output}')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -1,25 +1,69 @@
+# autofocus host; use 'http://localhost:8080' to run against the local mock server in shared/mockaf.py
 hostname = 'autofocus.paloaltonetworks.com'
+# max keep-alive connections to hostname shared by all Autofocus requests
+af_pool_size = 10
+# per-endpoint (connect, read) request timeouts in seconds
+af_timeouts = {'search': (10, 60), 'results': (10, 120), 'analysis': (10, 60), 'tags': (10, 60)}
+# points held back from the minute and daily quotas; the run pauses or stops before using them
+minute_points_reserve = 0
+daily_points_reserve = 500
+# times a request is resent after a minute quota exceeded response
+quota_retries = 5
+# times a request is resent after a lost connection or timeout; the wait starts at connection_backoff seconds and doubles
+connection_retries = 5
+connection_backoff = 1
 # elasticSearch bulk load url and port
 elastic_url_port = 'localhost:9200'
+# yes/no: bulk load the estack output to elasticSearch at the end of the run
+elastic_load = 'no'
+# elasticSearch 'username:password' for the bulk load; empty if no security features used
+elastic_auth = ''
+# bulk load requests in flight, max request size in bytes, and retries for rejected documents
+elastic_bulk_concurrency = 4
+elastic_bulk_bytes = 10 * 1024 * 1024
+elastic_bulk_retries = 5
 # querytype is autofocus for exported queries or hash when reading from hash list
 querytype = 'autofocus'
 # used for hash inputs; leave as default even if not using
 inputfile = 'hash_list.txt'
 # type of hash used in the input list when querytype is hash
 hashtype = 'sha256'
+# for hash queries ignore any AF hits whose hash is not in the input list
+ignore_unlisted = 'no'
 # for elasticSearch json build; index name and output dirs
 elk_index_name = 'hash-data'
 elk_index_name_session = 'session-data'
 out_estack = 'out_estack'
 out_pretty = 'out_pretty'
+# none, gzip, or zstd streaming compression of the estack and pretty outputs; zstd needs zstandard
+out_compression = 'none'
+# auto, orjson, or json serialization of the outputs and responses; auto uses orjson when installed
+json_backend = 'auto'
+# yes/no: session geo data from the bundled country centroids; Google only for codes not in the table
+geo_offline = 'yes'
+# new session geocodes held in memory and appended to data/geoData.csv in batches of this size
+geo_write_batch = 20
+
+# number of 1000-hash search blocks submitted and polled at the same time
+search_concurrency = 1
 
 # extend the data parsing to include a second search for sig coverage
 getsigdata = 'no'
+# number of sig coverage lookups in flight at the same time
+sig_concurrency = 4
+# reuse sig coverage fetched by earlier runs; cache is stored in the data dir
+sigcache = 'yes'
+sig_cache_file = 'data/sig_coverage_cache.db'
+# days before a cached sig coverage entry is fetched again and max cached samples
+sig_cache_ttl_days = 7
+sig_cache_max_entries = 500000
 # for testing to use existing pretty json output file and skip sample search
 onlygetsigs = 'no'
 # run a query to get the latest tag data; required periodically to ensure all tag info can be referenced
 # writes to the data dir
 gettagdata = 'no'
+# number of 200-tag pages fetched at the same time for the tag data refresh
+tag_concurrency = 4
 # adds exploit details to the data for exploit specific queries
 # get_exploits is either set to True or False
 get_exploits = False
@@ -36,5 +80,27 @@ out_csv = 'tag_group_stats_csv'
 # start month and year for time queries
 start_month = 10
 start_year = 2019
+# number of month and tag group count searches in flight at the same time
+stats_concurrency = 4
+# yes/no: tag group stats read only the search total and skip the returned hits
+stats_count_only = 'yes'
+# count-only searches end when the total is unchanged for this many polls; 0 waits for search completion
+stats_stable_polls = 3
+# yes/no: reuse tag group counts for closed months from a local sqlite file in the data dir
+statscache = 'yes'
+stats_cache_file = 'data/tag_group_stats_cache.db'
+# closed months always queried again to pick up late-arriving samples
+stats_refresh_months = 1
+# min and max seconds between cookie results polls; adapts to search progress
+poll_min_interval = 0.5
+poll_max_interval = 30
 # session search stall count; how many checks total same as process
 stall_stop = 10
+# dir for per query_tag search checkpoints used by --resume
+checkpoint_dir = 'checkpoints'
+# yes/no option to write a json run report of stage timings, request latency, and quota use
+metrics_report = 'yes'
+# dir for the json run reports
+metrics_dir = 'metrics'
+# node_exporter textfile collector dir for a Prometheus metrics file per script; leave blank to skip
+metrics_textfile_dir = ''
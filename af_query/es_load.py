@@ -0,0 +1,68 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''
+Palo Alto Networks es_load.py
+
+Bulk loads estack output files into Elasticsearch
+
+Each file is sent in size-bounded _bulk requests over several concurrent
+connections with retries for rejected documents
+
+This software is provided without support, warranty, or guarantee.
+Use at your own risk.
+'''
+
+import argparse
+import sys
+import os
+
+# adding shared dir for imports
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(here, '../shared')))
+# chunked concurrent elasticsearch bulk loader
+from esbulk import BulkLoader
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--filename", help="estack file to load", type=str, action='append')
+    parser.add_argument("-u", "--user", help="elasticSearch username:password", type=str)
+    parser.add_argument("-e", "--elastic_url_port", help="elasticSearch host:port if not conf.elastic_url_port",
+                        type=str)
+    parser.add_argument("-c", "--concurrency", help="number of bulk requests in flight", type=int)
+    args = parser.parse_args()
+
+    if not args.filename:
+        parser.print_help()
+        parser.exit()
+        exit(1)
+
+    loader = BulkLoader(url_port=args.elastic_url_port, auth=args.user, concurrency=args.concurrency)
+
+    for filename in args.filename:
+        if os.path.isfile(filename) is False:
+            print(f'\n{filename} not found')
+            sys.exit(1)
+        loader.load(filename)
+
+    loader.close()
+
+    if loader.failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
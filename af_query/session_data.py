@@ -33,12 +33,7 @@ Use at your own risk.
 import argparse
 import sys
 import os
-from os import path
-import csv
-import json
 import time
-from geopy.geocoders import GoogleV3
-from geopy.exc import GeocoderServiceError, GeocoderQueryError, GeocoderQuotaExceeded
 from datetime import datetime
 import requests
 
@@ -51,6 +46,30 @@ keys = None
 
 # script to create or update the tagdata.json list from Autofocus
 from gettagdata import tag_query
+# pooled keep-alive client shared by all Autofocus requests
+from afclient import get_client, retry_wait
+# raised by AFClient.post at the daily quota reserve
+from ratelimit import DailyQuotaExhausted
+# tag data indexed once per process for tag enrichment
+from tagindex import get_tag_index
+# adaptive wait between cookie results polls
+from afpoll import PollScheduler
+# buffered ndjson writer for the estack output files
+from estackwriter import EstackWriter
+# append-only writer for the pretty json output files
+from prettywriter import PrettyWriter
+# per query_tag search progress for --resume
+from checkpoint import Checkpoint
+# chunked concurrent elasticsearch bulk load or loader command print
+from esbulk import load_step
+# country geocodes loaded once with write-behind to data/geoData.csv
+from geocache import get_geo_cache
+# per-stage timing and quota use written as a run report
+from runmetrics import get_metrics
+# orjson or stdlib json serialization
+from jsoncodec import loads
+# slotted session documents with interned tag strings
+from records import SessionRecord, intern_all, empty, empty_map
 
 # local imports for static data input
 import conf
@@ -65,58 +84,8 @@ def get_geo(country_code, geo_key):
     :return:
     '''
 
-    # check if file exists and if not create it
-    if not path.isfile('data/geoData.csv'):
-        with open('data/geoData.csv', 'w') as geo_file:
-            geo_writer = csv.writer(geo_file, delimiter=',')
-            geo_writer.writerow(['country_code', 'latitude', 'longitude'])
-
-    # check local file cache if country already geocoded
-    with open('data/geoData.csv', 'r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if row[0] == country_code:
-                latitude = float(row[1])
-                longitude = float(row[2])
-                return latitude, longitude
-
-    # using GoogleV3 for geo lookups
-    geolocator = GoogleV3(api_key=geo_key)
-
-    try:
-        location = geolocator.geocode(components={'country' : country_code}, exactly_one=True)
-        # print(f'location is {country_code}')
-        # print(f'with lat: {location.latitude} and lon: {location.longitude}')
-
-        try:
-            with open('data/geoData.csv', 'a') as geo_file:
-                geo_writer = csv.writer(geo_file, delimiter=',')
-                geo_writer.writerow([country_code, location.latitude, location.longitude])
-            return location.latitude, location.longitude
-
-        except:
-            print('  ***** geocode lon-lat error - writing to geocoding-error.csv *****')
-            print(f'  Failed with message: no lon or lat for country {country_code}')
-
-            # append to the error file to see quick view of bad countries
-            with open('geocoding-error.csv', 'a') as uhoh:
-                geo_writer = csv.writer(uhoh, delimiter=',')
-                geo_writer.writerow([datetime.now(), country_code, 0, 0])
-
-            # append to the good file to avoid recurring geo lookups
-            with open('data/geoData.csv', 'a') as geo_file:
-                geo_writer = csv.writer(geo_file, delimiter=',')
-                geo_writer.writerow([country_code, 0, 0])
-            return 0, 0
-
-    except (GeocoderServiceError, GeocoderQueryError, GeocoderQuotaExceeded) as error_message:
-        print('  ***** geocode lookup error - writing to geocoding-error.csv *****')
-        print('  Failed with message: {0}'.format(error_message))
-        with open('geocoding-error.csv', 'a') as uhoh:
-            geo_writer = csv.writer(uhoh, delimiter=',')
-            geo_writer.writerow([datetime.now(), country_code, 1, 1])
-
-    return 0, 0
+    # in-memory lookup; new geocodes written to data/geoData.csv in batches
+    return get_geo_cache().get(country_code, geo_key)
 
 def elk_index():
     '''
@@ -179,34 +148,43 @@ def multi_query(searchlist, api_key):
     
     print(query)
 
-    search_values = {"apiKey": api_key,
-                      "query": query,
+    search_values = {"query": query,
                       "size": 4000,
                       # "scope": "global",
                       "type": "scan",
                       # "artifactSource": "af"
                      }
 
+    submit_start = time.perf_counter()
+    good_search = False
+    attempt = 0
 
-    headers = {"Content-Type": "application/json"}
-    search_url = f'https://{conf.hostname}/api/v1.0/sessions/search'
-
-    try:
-        search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-        print('Search query posted to Autofocus')
-        search.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print(search)
-        print(search.text)
-        print('\nCorrect errors and rerun the application\n')
-        sys.exit()
+    while good_search is False:
+        try:
+            search = get_client(api_key).post('sessions/search', search_values)
+            print('Search query posted to Autofocus')
+            search.raise_for_status()
+            good_search = True
+        except requests.exceptions.HTTPError:
+            print(search)
+            print(search.text)
+            print('\nCorrect errors and rerun the application\n')
+            sys.exit()
+        except requests.exceptions.ConnectionError:
+            retry_wait(attempt, 'lost connection during initial query')
+            attempt += 1
+        except requests.exceptions.Timeout:
+            retry_wait(attempt, 'timed out during initial query')
+            attempt += 1
 
-    search_dict = json.loads(search.text)
+    search_dict = loads(search.content)
+    get_metrics().observe('submit', time.perf_counter() - submit_start)
 
     return search_dict
 
 
-def scantype_query_results(search_dict, start_time, query_tag, search, api_key, geo_key):
+def scantype_query_results(search_dict, start_time, query_tag, search, api_key, geo_key, estack_writer,
+                           pretty_writer, found_hashes=None, checkpoint=None, written_sessions=None):
 
     '''
     With type=scan each results post with the same cookie will return
@@ -218,6 +196,11 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
     :param start_time: when the script started - used to track run time
     :param query_tag: identifier for this script run used as estack tag
     :param search: for multi-page search to denote which 1000 block being used
+    :param estack_writer: EstackWriter for the session estack file
+    :param pretty_writer: PrettyWriter for the session pretty file shared across search blocks
+    :param found_hashes: set updated with the lowercase sha256 of each parsed session, or None
+    :param checkpoint: Checkpoint updated after each written page, or None
+    :param written_sessions: session ids written before a --resume, skipped when a block is searched again
     :return: autofocus search results dictionary or null if no hits
     '''
 
@@ -231,38 +214,56 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
     index = 1
     stall_count = 1
     totalsamples = 0
+    stop_event = None
+    # a block searched again after a lost page skips sessions written by the earlier search
+    skip_sessions = None
+
+    if checkpoint is not None:
+        index += checkpoint.block(search)['pages']
+        stop_event = checkpoint.stopping
+        if checkpoint.block(search).get('requery', False):
+            skip_sessions = written_sessions
 
     running_total = []
     running_length = []
 
-    # looping across 1000 element input lists requires a file read if > 1 loops
-    if search == 1:
-        all_sample_dict = {}
-        all_sample_dict['sessions'] = []
-    else:
-        with open(f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json', 'r') as hash_file:
-            all_sample_dict = json.load(hash_file)
+    poller = PollScheduler()
 
     while search_progress != 'FIN':
 
-        time.sleep(5)
+        poller.wait(stop_event)
+        # Ctrl-C ends the search here between pages so the checkpoint matches the output files
+        if stop_event is not None and stop_event.is_set():
+            print(f'search {search} stopped at page {index}')
+            return autofocus_results
+
+        fetch_start = time.perf_counter()
         try:
-            # results_url = f'https://{conf.hostname}/api/v1.0/samples/results/' + cookie
-            results_url = f'https://{conf.hostname}/api/v1.0/sessions/results/' + cookie
-            headers = {"Content-Type": "application/json"}
-            results_values = {"apiKey": api_key}
-            results = requests.post(results_url, headers=headers, data=json.dumps(results_values))
+            results = get_client(api_key).post(f'sessions/results/{cookie}', {})
             results.raise_for_status()
         except requests.exceptions.HTTPError:
             print(results)
             print(results.text)
             print('\nCorrect errors and rerun the application\n')
             sys.exit()
-
-        # testing only to see json dict fields
-        autofocus_results = results.json()
-        with open('test.txt', 'w') as file:
-            file.write(json.dumps(autofocus_results, indent=4, sort_keys=False) + "\n")
+        except requests.exceptions.ConnectTimeout:
+            # the poll never reached Autofocus so the cookie has not moved
+            print('timed out connecting for get data query - polling again')
+            get_metrics().count('results_retries')
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # Autofocus may have sent the page and moved the cookie on; never poll past a lost page
+            if checkpoint is None:
+                print(f'\nResults page for search interval {search} may have been lost')
+                print('\nCorrect errors and rerun the application\n')
+                sys.exit()
+            checkpoint.results_lost(search)
+            return autofocus_results
+
+        autofocus_results = loads(results.content)
+        get_metrics().observe('fetch', time.perf_counter() - fetch_start)
+        get_metrics().count('pages')
+        poller.update(autofocus_results)
 
         if 'total' in autofocus_results:
 
@@ -271,10 +272,13 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
 
             if autofocus_results['total'] != 0:
                 # parse data and output estack json elements
-                # return is running dict of all samples for pretty json output
-                all_sample_dict = parse_sample_data(autofocus_results, start_time, index, query_tag, all_sample_dict, search, geo_key)
-                with open(f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json', 'w') as hash_file:
-                    hash_file.write(json.dumps(all_sample_dict, indent=2, sort_keys=False) + "\n")
+                # pretty json records are appended and the file written at the end of the run
+                parse_sample_data(autofocus_results, start_time, query_tag, pretty_writer,
+                                  geo_key, estack_writer, found_hashes, skip_sessions)
+                estack_writer.flush()
+                pretty_writer.flush()
+                if checkpoint is not None:
+                    checkpoint.page_done(search, estack_writer, pretty_writer)
                 index += 1
 
                 print(f'Results update for page {index}: {query_tag}\n')
@@ -305,7 +309,9 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
 
         else:
             print('Autofocus still queuing up the search...')
-            time.sleep(5)
+
+    if checkpoint is not None:
+        checkpoint.finish_block(search, estack_writer, pretty_writer)
 
     print('\n')
     print('=' * 80)
@@ -318,35 +324,58 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
     return autofocus_results
 
 
-def parse_sample_data(autofocus_results, start_time, index, query_tag, session_data_dict_pretty, search, geo_key):
+def parse_sample_data(autofocus_results, start_time, query_tag, pretty_writer, geo_key, estack_writer,
+                      found_hashes=None, skip_sessions=None):
 
     '''
     parse the AF reponse and augment the data with file type, tag, malware
     then write 2 files: pretty json and estack for bulk load into elasticsearch
     :param autofocus_results: array of data from AF multi-query response
     :param start_time: time script started; used to track run time
-    :param index: note which cycle through the search block for file w or a
     :param query_tag: identifier for this script run used as estack tag
-    :param search: for multi-page search to denote which 1000 block being used
-    :param session_data_dict_pretty: master set of data to write out to json
-    :return: update dictionary with sample data
+    :param pretty_writer: PrettyWriter for the session pretty file
+    :param geo_key: api key used by Google mapping
+    :param estack_writer: EstackWriter for the session estack file
+    :param found_hashes: set updated with the lowercase sha256 of each parsed session, or None
+    :param skip_sessions: session ids already written, or None to keep all
+    :return:
     '''
 
     # mapping of tag # to text name
     # malware_values = {'0': 'benign', '1': 'malware', '2': 'grayware', '3': 'phishing'}
 
-    index_tag_full = elk_index()
-
     # used to have a full view of AF tag data for data augmentation
     # for a current list, should run gettagdata.py periodically
-    with open('data/tagdata.json', 'r') as tag_file:
-        tag_dict = json.load(tag_file)
+    tag_index = get_tag_index()
 
     listsize = len(autofocus_results['hits'])
 
-    # interate through AF results to create dict key/values for each sample hash
+    field_list = [
+        'sha256','tstamp',
+        'device_industry','region',
+        'dst_countrycode', 'dst_country', 'dst_port',
+        'src_countrycode', 'src_country', 'src_port',
+        'upload_src', 'app', 'status'
+    ]
+    # repeated values shared across records
+    interned_fields = SessionRecord.interned
+
+    # shared by every record on the page
+    query_tag = sys.intern(query_tag)
+    query_time = sys.intern(str(start_time))
+
+    # stage times summed over the page and recorded once per page
+    parse_start = time.perf_counter()
+    geo_seconds = 0.0
+    enrich_seconds = 0.0
+    write_seconds = 0.0
+
+    # interate through AF results to create a compact record for each session
     for listpos in range(0, listsize):
         session_id = autofocus_results['hits'][listpos]['_id']
+        if skip_sessions is not None and session_id in skip_sessions:
+            continue
+        hit_source = autofocus_results['hits'][listpos]['_source']
 
         # Autofocus sending back bad data - ignore if not in source hash_list
         # source_list = get_search_list()
@@ -354,34 +383,33 @@ def parse_sample_data(autofocus_results, start_time, index, query_tag, session_d
         # only for hash searches
         #if keyhash in source_list:
 
-        session_data_dict = {}
-
-        # AFoutput is json output converted to python dictionary
-        session_data_dict['session_id'] = session_id
+        # AFoutput is json output converted to a slotted record; unset fields are not written
+        session_record = SessionRecord(session_id=session_id)
 
-        fieldList = [
-            'sha256','tstamp',
-            'device_industry','region',
-            'dst_countrycode', 'dst_country', 'dst_port',
-            'src_countrycode', 'src_country', 'src_port',
-            'upload_src', 'app', 'status'
-        ]
-
-        for field in fieldList:
-            if field in autofocus_results['hits'][listpos]['_source']:
-                session_data_dict[field] = autofocus_results['hits'][listpos]['_source'][field]
+        for field in field_list:
+            if field in hit_source:
+                value = hit_source[field]
+                if field in interned_fields and isinstance(value, str):
+                    value = sys.intern(value)
+                setattr(session_record, field, value)
 
                 # get lat and long coordinates for src and dst countries
                 if field == 'dst_countrycode':
-                    session_data_dict['dst_lat'], session_data_dict['dst_lon'] = \
-                        get_geo(autofocus_results['hits'][listpos]['_source'][field], geo_key)
+                    geo_start = time.perf_counter()
+                    session_record.dst_lat, session_record.dst_lon = get_geo(value, geo_key)
+                    geo_seconds += time.perf_counter() - geo_start
 
                 if field == 'src_countrycode':
-                    session_data_dict['src_lat'], session_data_dict['src_lon'] = \
-                        get_geo(autofocus_results['hits'][listpos]['_source'][field], geo_key)
+                    geo_start = time.perf_counter()
+                    session_record.src_lat, session_record.src_lon = get_geo(value, geo_key)
+                    geo_seconds += time.perf_counter() - geo_start
+
+        session_record.query_tag = query_tag
+        session_record.query_time = query_time
 
-        session_data_dict['query_tag'] = query_tag
-        session_data_dict['query_time'] = str(start_time)
+        # found hashes tracked as pages are parsed for the missing samples check
+        if found_hashes is not None and session_record.sha256 is not None:
+            found_hashes.add(session_record.sha256.lower())
 
         # initial AF query to get sample data include sha256 hash and WF verdict
         # sha256 is required for sig queries; does not support md5 or sha1
@@ -389,25 +417,32 @@ def parse_sample_data(autofocus_results, start_time, index, query_tag, session_d
         # verdict_text = malware_values[str(verdict_num)]
         # hash_data_dict['verdict'] = verdict_text
 
-        if 'tag' in autofocus_results['hits'][listpos]['_source']:
+        enrich_start = time.perf_counter()
+
+        if 'tag' in hit_source:
 
-            session_data_dict['all_tags'] = autofocus_results['hits'][listpos]['_source']['tag']
+            all_tags = intern_all(hit_source['tag'])
+            session_record.all_tags = all_tags
+            session_record.tag_array = empty_map
 
+            tag_matched = False
             priority_tags_public = []
             priority_tags_name = []
             tag_classes = []
-            session_data_dict['tag_array'] = {}
             malware_tags = []
             campaign_tags = []
             actor_tags = []
             exploit_tags = []
 
-            for tag in session_data_dict['all_tags']:
+            for tag in all_tags:
 
-                if 'tag_class' in tag_dict['_tags'][tag]:
+                tag_record = tag_index.get(tag)
 
-                    tag_class = tag_dict['_tags'][tag]['tag_class']
-                    tag_name = tag_dict['_tags'][tag]['tag_name']
+                if tag_record is not None and tag_record.tag_class is not None:
+
+                    tag_matched = True
+                    tag_class = tag_record.tag_class
+                    tag_name = tag_record.tag_name
                     if tag_class in ('malware_family', 'campaign', 'actor', 'exploit'):
                         priority_tags_public.append(tag)
                         priority_tags_name.append(tag_name)
@@ -428,71 +463,74 @@ def parse_sample_data(autofocus_results, start_time, index, query_tag, session_d
                         elif tag_class == 'exploit':
                             exploit_tags.append(tag_name)
 
-                    session_data_dict['priority_tags_public'] = priority_tags_public
-                    session_data_dict['priority_tags_name'] = priority_tags_name
-                    session_data_dict['tag_classes'] = tag_classes
-                    session_data_dict['malware_tags'] = malware_tags
-                    session_data_dict['campaign_tags'] = campaign_tags
-                    session_data_dict['actor_tags'] = actor_tags
-                    session_data_dict['exploit_tags'] = exploit_tags
-
-                if 'tag_groups' in tag_dict['_tags'][tag]:
-                    taggroups = []
-                    for group in tag_dict['_tags'][tag]['tag_groups']:
-                        if group not in taggroups:
-                            taggroups.append(group['tag_group_name'])
-
-                    session_data_dict['tag_groups'] = taggroups
-
-        # this creates a json format with first record as samples then appended json list entries
-        # proper json format to read the file in during run to append with new data
-        session_data_dict_pretty['sessions'].append(session_data_dict)
-
-        # Write dict contents to running file both estack and pretty json versions
-        if index == 1 and listpos == 0 and search == 1:
-            with open(f'{conf.out_estack}/session_data_estack_{query_tag}_nosigs.json', 'w') as session_file:
-                session_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                session_file.write(json.dumps(session_data_dict, indent=None, sort_keys=False) + "\n")
-        else:
-            with open(f'{conf.out_estack}/session_data_estack_{query_tag}_nosigs.json', 'a') as session_file:
-                session_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                session_file.write(json.dumps(session_data_dict, indent=None, sort_keys=False) + "\n")
+                if tag_record is not None and tag_record.tag_groups is not None:
+                    session_record.tag_groups = tag_record.tag_groups
+
+            # tag class lists are only written once a tag is found in the local tag data
+            if tag_matched is True:
+                session_record.priority_tags_public = tuple(priority_tags_public) or empty
+                session_record.priority_tags_name = tuple(priority_tags_name) or empty
+                session_record.tag_classes = tuple(tag_classes) or empty
+                session_record.malware_tags = tuple(malware_tags) or empty
+                session_record.campaign_tags = tuple(campaign_tags) or empty
+                session_record.actor_tags = tuple(actor_tags) or empty
+                session_record.exploit_tags = tuple(exploit_tags) or empty
+
+        write_start = time.perf_counter()
+        enrich_seconds += write_start - enrich_start
+
+        # serialized once for both outputs
+        record_text = session_record.to_json()
+
+        # pretty json is built from the appended records at the end of the run
+        pretty_writer.write_json(record_text)
+
+        # add record contents to the running estack file
+        estack_writer.write_json(record_text)
+
+        write_seconds += time.perf_counter() - write_start
 
         # only for hash searches
         #else:
         #    print('Ignoring unexpected hash found: ' + keyhash)
 
-    return session_data_dict_pretty
+    metrics = get_metrics()
+    metrics.observe('parse', time.perf_counter() - parse_start)
+    metrics.observe('geo', geo_seconds)
+    metrics.observe('enrich', enrich_seconds)
+    metrics.observe('write', write_seconds)
+    metrics.count('records', listsize)
 
 
-def missing_samples(query_tag, start_time):
+def missing_samples(query_tag, start_time, hash_list, found_hashes, estack_writer, pretty_writer):
     '''
     once the query is complete and samples found have to look for misses
-    this reads in the pretty json file to get the found list
+    input hashes are checked against the set of session sha256 values found while parsing
     then appends the estack and pretty nosigs files with hash misses
+    :param hash_list: input hash list
+    :param found_hashes: set of lowercase sha256 hashes found by the search
+    :param estack_writer: EstackWriter for the session estack file
+    :param pretty_writer: PrettyWriter for the session pretty file
     :return:
     '''
 
-    index_tag_full = elk_index()
-
-    # initialize tracking dict for samples not found
-    samples_notfound_dict = {}
-    hash_list = get_search_list()
+    # session results only carry the sample sha256
+    if conf.hashtype != 'sha256':
+        print('Missing sample check for sessions requires hashtype sha256 - skipping')
+        return
 
     missing_sample_date = start_time.strftime('%Y-%m-%dT%H:%M:%S')
-
-    # read in the full set of samples after query is complete
-    with open(f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json', 'r') as samplesfile:
-        samples_dict = json.load(samplesfile)
-
-    found_list = []
-    for sample in samples_dict['samples']:
-        found_list.append(sample['hashvalue'])
+    missing_count = 0
 
     for sample in hash_list:
-        if sample in found_list:
-            pass
-        else:
+        sample_key = sample.lower()
+        if sample_key not in found_hashes:
+            # add to the found set so duplicate input hashes are only reported once
+            found_hashes.add(sample_key)
+            missing_count += 1
+
+            # new tracking dict for each sample not found
+            samples_notfound_dict = {}
             samples_notfound_dict['hashvalue'] = sample
             samples_notfound_dict['sample_found'] = False
             samples_notfound_dict['query_tag'] = query_tag
@@ -501,14 +539,12 @@ def missing_samples(query_tag, start_time):
             samples_notfound_dict['verdict'] = 'No Sample Found'
 
             # Write dict contents to running file both estack and pretty json versions
-            with open(f'{conf.out_estack}/session_data_estack_{query_tag}_nosigs.json', 'a') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(samples_notfound_dict, indent=None, sort_keys=False) + "\n")
+            estack_writer.write(samples_notfound_dict)
+            pretty_writer.write(samples_notfound_dict)
 
-            samples_dict['samples'].append(samples_notfound_dict)
-
-    with open(f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json', 'w') as hash_file:
-        hash_file.write(json.dumps(samples_dict, indent=4, sort_keys=False) + "\n")
+    get_metrics().count('records', missing_count)
+    get_metrics().count('missing_samples', missing_count)
+    print(f'{missing_count} input hashes not found in Autofocus')
 
 
 def main():
@@ -518,6 +554,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-k", "--api_key", help="Autofocus API key", type=str)
     parser.add_argument("-g", "--geo_key", help="Google API key", type=str)
+    parser.add_argument("-r", "--resume", help="continue an interrupted search from its checkpoint",
+                        action="store_true")
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -533,11 +571,12 @@ def main():
 
     # for longer lists may have to break list in 1000 size pieces
     # for autofocus type queries on do a single search
-    numsearches = 1
+    search_blocks = [[]]
 
     query_tag = input('Enter brief tag name for this data: ')
     start_time = datetime.now()
-    listend = -1
+    # run timing starts here; stage metrics are reported at the end of the run
+    get_metrics()
     ok_to_get_sigs = True
 
     # refresh tag data list
@@ -559,47 +598,115 @@ def main():
     if conf.querytype == 'hash':
         # read items list from file
         search_list_all = get_search_list()
-        listlength = len(search_list_all)
-        numsearches = int(listlength / 1000) + 1
-
-    for search in range(1, numsearches + 1):
-    #submit bulk query for sample data to AF
-
-        print(f'\nworking with search interval {search} of {numsearches}')
-        liststart = listend + 1
-        listend += 1000
-
-        search_list = search_list_all[liststart:listend]
-        print(f'query is sending {len(search_list)} items as search elements')
-
-        searchrequest = multi_query(search_list, api_key)
-
-        #get query results and parse output
-        scantype_query_results(searchrequest, start_time, query_tag, search, api_key, geo_key)
-
-    # check that the output sigs file exists if AF hits 1= 0
-    # if no file, check that hashtype in conf.py matches hashlist.txt type
+        search_blocks = [search_list_all[liststart:liststart + 1000]
+                         for liststart in range(0, len(search_list_all), 1000)] or [[]]
+
+    numsearches = len(search_blocks)
+    found_hashes = set()
+    # session ids from an earlier run, skipped if a block is searched again after a lost page
+    written_sessions = set()
+
+    # search progress is saved after each page for --resume
+    checkpoint = Checkpoint('session_data', query_tag)
+    estack_file = f'{conf.out_estack}/session_data_estack_{query_tag}_nosigs.json'
+    pretty_file = f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json'
+
+    if args.resume is True and checkpoint.exists():
+        checkpoint.load()
+        if checkpoint.state['numsearches'] != numsearches:
+            print(f'\nCheckpoint {checkpoint.filename} has {checkpoint.state["numsearches"]} search blocks '
+                  f'but the current search list has {numsearches}')
+            print('Restore the original search list or run without --resume\n')
+            sys.exit(1)
+        print(f'\nResuming {query_tag} from {checkpoint.filename}')
+        start_time = checkpoint.start_time()
+        # drop any partial page written after the last checkpoint then append
+        checkpoint.truncate_outputs()
+        estack_writer = EstackWriter(estack_file, elk_index(), mode='a')
+        pretty_writer = PrettyWriter(pretty_file, 'sessions', mode='a')
+        checkpoint.restore_records(estack_writer, pretty_writer)
+        for record in pretty_writer.records_written():
+            if 'sha256' in record:
+                found_hashes.add(record['sha256'].lower())
+            if 'session_id' in record:
+                written_sessions.add(record['session_id'])
+    else:
+        if args.resume is True:
+            print(f'\nNo checkpoint found for {query_tag}: starting a new search')
+        checkpoint.start(start_time, numsearches)
+        # one estack file held open for all search blocks and missing samples
+        estack_writer = EstackWriter(estack_file, elk_index())
+        pretty_writer = PrettyWriter(pretty_file, 'sessions')
+
+    # Ctrl-C stops at a page boundary only during the search
+    checkpoint.install_stop_handler()
     try:
-        with open(f'{conf.out_pretty}/session_data_pretty_{query_tag}_nosigs.json', 'r'):
-            pass
-    except IOError as nofile_error:
-        print(nofile_error)
-        print(f'Unable to open out_pretty/session_data_pretty_{query_tag}_nosigs.json')
-        print('This file is output from the initial sample search and read in to create a sig coverage output')
+        for search, search_list in enumerate(search_blocks, 1):
+        #submit bulk query for sample data to AF
+
+            if checkpoint.stopping.is_set():
+                break
+
+            block = checkpoint.block(search)
+            if block is not None and block['done'] is True:
+                print(f'\nsearch interval {search} of {numsearches} already complete')
+                continue
+
+            if block is not None and block['cookie'] is not None:
+                # resumed block: keep polling the saved cookie for the remaining pages
+                print(f'\nresuming search interval {search} of {numsearches} after page {block["pages"]}')
+                searchrequest = {'af_cookie': block['cookie']}
+            else:
+                requery = block is not None and block.get('requery', False)
+                if requery:
+                    print(f'\nsearching interval {search} of {numsearches} again after a lost results page')
+                else:
+                    print(f'\nworking with search interval {search} of {numsearches}')
+                print(f'query is sending {len(search_list)} items as search elements')
+
+                searchrequest = multi_query(search_list, api_key)
+                checkpoint.start_block(search, searchrequest['af_cookie'], requery)
+
+            #get query results and parse output
+            scantype_query_results(searchrequest, start_time, query_tag, search, api_key, geo_key, estack_writer,
+                                   pretty_writer, found_hashes, checkpoint, written_sessions)
+    except DailyQuotaExhausted as quota_message:
+        # writers are closed below and the run exits through the checkpoint
+        checkpoint.quota_exhausted(quota_message)
+    finally:
+        checkpoint.restore_stop_handler()
+
+    if checkpoint.stopping.is_set():
+        # keep the json lines intermediate so the resumed run can append to it
+        estack_writer.close()
+        pretty_writer.close(materialize=False)
+        get_metrics().write_report('session_data.py', query_tag)
+        checkpoint.exit_stopped('session_data.py')
+
+    # check that the search found sessions if AF hits 1= 0
+    # if none, check that hashtype in conf.py matches hashlist.txt type
+    if pretty_writer.records == 0:
+        print(f'No sessions found for out_pretty/session_data_pretty_{query_tag}_nosigs.json')
         print('If hits are expected check that the hashtype in conf.py matches the hashes in hash_list.txt')
         ok_to_get_sigs = False
 
     # find AF sample misses and add to the estack json file as not found
     if conf.querytype == 'hash':
-        missing_samples(query_tag, start_time)
+        missing_samples(query_tag, start_time, search_list_all, found_hashes, estack_writer, pretty_writer)
+
+    # pretty json output is written once from the appended records
+    estack_writer.close()
+    pretty_writer.close()
+    checkpoint.remove()
 
     if conf.querytype == 'autofocus':
             print(conf.af_query)
 
-    # print out the elasticSearch bulk load based on the tag and thus filename
-    print('\nuse the curl command to load estack data to elasticSearch')
-    print('either ignore -u if no security features used or append with elasticSearch username and password\n')
-    print(f'curl -s -XPOST \'http://{conf.elastic_url_port}/_bulk\' --data-binary @out_estack/session_data_estack_{query_tag}_nosigs.json -H \"Content-Type: application/x-ndjson\" -u user:password\n\n')
+    # bulk load to elasticSearch or print the loader command based on the tag and thus filename
+    load_step(f'{conf.out_estack}/session_data_estack_{query_tag}_nosigs.json')
+
+    get_client(api_key).print_latency()
+    get_metrics().write_report('session_data.py', query_tag)
 
 if __name__ == '__main__':
     main()
@@ -8,9 +8,10 @@ import sys
 import argparse
 import os
 import time
-import json
+import re
 import requests
 import calendar
+from collections import deque
 from urllib3.exceptions import ProtocolError
 from http.client import RemoteDisconnected
 from datetime import datetime
@@ -21,6 +22,27 @@ here = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.normpath(os.path.join(here, '../shared')))
 # script to create or update the tagdata.json list from Autofocus
 from gettagdata import tag_query
+# pooled keep-alive client shared by all Autofocus requests
+from afclient import get_client, quota_exit
+# adaptive wait between cookie results polls
+from afpoll import PollScheduler
+# buffered ndjson writer for the estack output files
+from estackwriter import EstackWriter
+# chunked concurrent elasticsearch bulk load or loader command print
+from esbulk import load_step
+# stored counts for closed months
+from statscache import StatsCountCache
+# quota values read from the raw results text and the daily quota reserve error
+from ratelimit import minute_regex, daily_regex, DailyQuotaExhausted
+# per-stage timing and quota use written as a run report
+from runmetrics import get_metrics
+# orjson or stdlib json serialization
+from jsoncodec import loads
+
+# count-only results fields read from the raw response text so hit bodies are never decoded
+total_regex = re.compile(r'"total"\s*:\s*(\d+)')
+in_progress_regex = re.compile(r'"af_in_progress"\s*:\s*(true|false)')
+percent_regex = re.compile(r'"af_complete_percentage"\s*:\s*(\d+(?:\.\d+)?)')
 
 
 def elk_index(elk_index_name):
@@ -72,23 +94,25 @@ def monthly_stats(tag_group, startdate, enddate, verdict, api_key):
                                    "value": [f"{startdate}T00:00:00", f"{enddate}T23:59:59"]},
                                 ]}
 
+    # only the total is used so count-only searches ask for the smallest page of hits
+    if getattr(conf, 'stats_count_only', 'yes') == 'yes':
+        size = 1
+    else:
+        size = 50
+
     print('Initiating query to Autofocus')
-    search_values = {"apiKey": api_key,
-                     "query": afquery,
-                     "size": 50,
+    search_values = {"query": afquery,
+                     "size": size,
                      "scope": "global",
                      "from": 0,
                      "artifactSource": "af"
                     }
 
-    headers = {"Content-Type": "application/json"}
-    search_url = f'https://{conf.hostname}/api/v1.0/samples/search'
-
     good_search = False
 
     while good_search is False:
         try:
-            search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
+            search = get_client(api_key).post('samples/search', search_values)
             print('Search query posted to Autofocus')
             search.raise_for_status()
             good_search = True
@@ -101,96 +125,217 @@ def monthly_stats(tag_group, startdate, enddate, verdict, api_key):
             print('kicked out early - protocol error - trying again')
         except requests.exceptions.ConnectionError:
             print('lost connection during initial query - trying again')
+        except requests.exceptions.Timeout:
+            print('timed out during initial query - trying again')
         except RemoteDisconnected:
             print('client disconnect error during initial query - trying again')
 
-    search_dict = json.loads(search.text)
+    search_dict = loads(search.content)
 
     return search_dict
 
 
 
-def get_query_results(search_dict, startTime, api_key):
+def count_results(results_text):
+
+    """
+    read the count fields from a results response without decoding the hits
+    :param results_text: results/{cookie} response text
+    :return: dict with total, af_in_progress, af_complete_percentage, and bucket_info when present
+    """
+
+    autofocus_results = {'hits': []}
+
+    total = total_regex.search(results_text)
+    if total is not None:
+        autofocus_results['total'] = int(total.group(1))
+
+    in_progress = in_progress_regex.search(results_text)
+    if in_progress is not None:
+        autofocus_results['af_in_progress'] = in_progress.group(1) == 'true'
+
+    percent = percent_regex.search(results_text)
+    if percent is not None:
+        autofocus_results['af_complete_percentage'] = float(percent.group(1))
+
+    minute_match = minute_regex.search(results_text)
+    daily_match = daily_regex.search(results_text)
+    if minute_match is not None and daily_match is not None:
+        autofocus_results['bucket_info'] = {'minute_points_remaining': int(minute_match.group(1)),
+                                            'daily_points_remaining': int(daily_match.group(1))}
+
+    return autofocus_results
+
+
+def submit_stats_search(cell, api_key):
 
     """
-    keep checking autofocus until a hit or search complete
-    :param search_dict: initial response including the cookie value
-    :return: autofocus search results dictionary or null if no hits
+    submit the count search for one month and tag group cell
+    :param cell: dict with tag_group, date, enddate, and verdict for the search
     """
 
-    autofocus_results = {}
+    with get_metrics().timer('submit'):
+        search_dict = monthly_stats(cell['tag_group'], cell['date'], cell['enddate'], cell['verdict'], api_key)
+    cell['cookie'] = search_dict['af_cookie']
+    cell['last_total'] = None
+    cell['stable_polls'] = 0
+    # count searches return the same hits every poll so only a scan page resets the wait
+    cell['poller'] = PollScheduler(scan=False)
+    cell['next_poll'] = time.monotonic() + cell['poller'].interval
+    print(f"Tracking cookie is {cell['cookie']} for {cell['date'][:7]} and tag_group = {cell['tag_group']}")
+
+
+def poll_stats_search(cell, startTime, api_key):
+
+    """
+    one results poll for an in-flight search
+    :param cell: search cell with cookie and poller from submit_stats_search
+    :return: 'running', 'done' with the count in cell['total'], or 'retry' to resubmit the search
+    """
+
+    fetch_start = time.perf_counter()
+    try:
+        results = get_client(api_key).post(f"samples/results/{cell['cookie']}", {})
+        results.raise_for_status()
+    except requests.exceptions.HTTPError:
+        print(results)
+        print(results.text)
+        print('\nCorrect errors and rerun the application\n')
+        sys.exit()
+    except ProtocolError:
+        print('kicked out getting results due to disconnect')
+        return 'retry'
+    except requests.exceptions.ConnectionError:
+        print('lost connection during get data query')
+        return 'retry'
+    except requests.exceptions.Timeout:
+        print('timed out during get data query')
+        return 'retry'
+    except RemoteDisconnected:
+        print('client disconnect error - should try again')
+        return 'retry'
+
+    if getattr(conf, 'stats_count_only', 'yes') == 'yes':
+        autofocus_results = count_results(results.text)
+        stable_stop = getattr(conf, 'stats_stable_polls', 3)
+    else:
+        autofocus_results = loads(results.content)
+        stable_stop = 0
+
+    get_metrics().observe('fetch', time.perf_counter() - fetch_start)
 
-    cookie = search_dict['af_cookie']
-    print(f'Tracking cookie is {cookie}')
-    print('Getting sample data...\n')
+    cell['poller'].update(autofocus_results)
+    cell['next_poll'] = time.monotonic() + cell['poller'].interval
 
-    search_progress = 'start'
-    index = 1
+    if 'total' not in autofocus_results:
+        return 'running'
 
-    running_total = []
-    running_length = []
-    all_sample_dict = {}
-    all_sample_dict['samples'] = []
+    # count-only searches also end once the total stops changing after the search has started
+    if autofocus_results['total'] == cell['last_total'] and autofocus_results.get('af_complete_percentage', 0) > 0:
+        cell['stable_polls'] += 1
+    else:
+        cell['stable_polls'] = 0
+    cell['last_total'] = autofocus_results['total']
 
-    while search_progress != 'FIN':
+    if autofocus_results.get('af_in_progress') is False or 0 < stable_stop <= cell['stable_polls']:
+        cell['total'] = autofocus_results['total']
+        # a total taken from stable polls may still grow, so only a finished search is cached as final
+        cell['complete'] = autofocus_results.get('af_in_progress') is False
+        print(f"{cell['date'][:7]} {cell['tag_group']}: total hits {cell['total']}")
+        if 'bucket_info' in autofocus_results:
+            minute_pts_rem = autofocus_results['bucket_info']['minute_points_remaining']
+            daily_pts_rem = autofocus_results['bucket_info']['daily_points_remaining']
+            print(f'AF quota update: {minute_pts_rem} minute points and {daily_pts_rem} daily points remaining')
+        elapsedtime = datetime.now() - startTime
+        print(f'Elasped run time is {elapsedtime}')
+        print('-' * 80)
+        return 'done'
 
-        time.sleep(5)
-        good_search = False
+    return 'running'
 
-        while good_search is False:
-            try:
-                results_url = f'https://{conf.hostname}/api/v1.0/samples/results/' + cookie
-                headers = {"Content-Type": "application/json"}
-                results_values = {"apiKey": api_key}
-                results = requests.post(results_url, headers=headers, data=json.dumps(results_values))
-                results.raise_for_status()
-                good_search = True
-            except requests.exceptions.HTTPError:
-                print(results)
-                print(results.text)
-                print('\nCorrect errors and rerun the application\n')
-                sys.exit()
-            except ProtocolError:
-                print('kicked out getting results due to disconnect')
-                return None
-            except requests.exceptions.ConnectionError:
-                print('lost connection during get data query')
-                return None
-            except RemoteDisconnected:
-                print('client disconnect error - should try again')
-                return None
 
-        autofocus_results = results.json()
+def write_stats_record(estack_writer, cell, mal_count):
 
+    """
+    write the monthly count record for one month and tag group
+    :param estack_writer: EstackWriter for tag_group_summary.json
+    :param cell: search cell for the month and tag group
+    :param mal_count: malware verdict sample count
+    """
 
-        if 'total' in autofocus_results:
+    mal_dailyavg = int(mal_count / cell['endday'])
 
-            running_total.append(autofocus_results['total'])
-            running_length.append(len(autofocus_results['hits']))
+    monthly_count_dict = {}
+    monthly_count_dict['date'] = cell['date']
+    monthly_count_dict['tag_group'] = cell['tag_group']
+    monthly_count_dict['malware_monthly_count'] = mal_count
+    monthly_count_dict['malware_daily_average'] = mal_dailyavg
 
-            if autofocus_results['total'] != 0:
-                # parse data and output estack json elements
-                # return is running dict of all samples for pretty json output
+    with get_metrics().timer('write'):
+        estack_writer.write(monthly_count_dict)
+        estack_writer.flush()
+    get_metrics().count('records')
 
-                print(f'Results update\n')
-                print(f"samples found so far: {autofocus_results['total']}")
-                print(f"Search percent complete: {autofocus_results['af_complete_percentage']}%")
-                minute_pts_rem = autofocus_results['bucket_info']['minute_points_remaining']
-                daily_pts_rem = autofocus_results['bucket_info']['daily_points_remaining']
-                print(f'AF quota update: {minute_pts_rem} minute points and {daily_pts_rem} daily points remaining')
-                elapsedtime = datetime.now() - startTime
-                print(f'Elasped run time is {elapsedtime}')
-                print('-' * 80)
 
+def run_stats_searches(cells, startTime, api_key, estack_writer, cache=None):
 
-            if autofocus_results['af_in_progress'] is False :
-                search_progress = 'FIN'
-        else:
-            print('Autofocus still queuing up the search...')
+    """
+    keep up to conf.stats_concurrency searches in flight and poll their cookies round-robin
+    freed slots are filled from the queue and results are written in cell order
+    :param cells: search cells in output order; cells with a total already set are not searched
+    :param estack_writer: EstackWriter for tag_group_summary.json
+    :param cache: StatsCountCache to store new counts, or None
+    """
 
-    print(f"total hits: {autofocus_results['total']}")
+    concurrency = max(getattr(conf, 'stats_concurrency', 4), 1)
+    queue = deque(index for index, cell in enumerate(cells) if 'total' not in cell)
+    active = []
+    done = {index: cell['total'] for index, cell in enumerate(cells) if 'total' in cell}
+    next_write = 0
+
+    # cells filled from the cache are written here too when no search is left to run
+    while queue or active or next_write in done:
+
+        # results written in deterministic order as the earliest cells complete
+        while next_write in done:
+            write_stats_record(estack_writer, cells[next_write], done.pop(next_write))
+            next_write += 1
+
+        while queue and len(active) < concurrency:
+            index = queue.popleft()
+            print('=' * 80)
+            print(f"starting search for {cells[index]['date'][:7]} and tag_group = {cells[index]['tag_group']}\n")
+            submit_stats_search(cells[index], api_key)
+            active.append(index)
+
+        if not active:
+            continue
+
+        # sleep until the next cookie is due then poll every due cookie once
+        wait = min(cells[index]['next_poll'] for index in active) - time.monotonic()
+        if wait > 0:
+            with get_metrics().timer('poll_wait'):
+                time.sleep(wait)
+
+        now = time.monotonic()
+        for index in list(active):
+            if cells[index]['next_poll'] > now:
+                continue
 
-    return autofocus_results['total']
+            status = poll_stats_search(cells[index], startTime, api_key)
+            if status == 'running':
+                continue
+
+            active.remove(index)
+            if status == 'retry':
+                # resubmitted ahead of the queue to keep output order moving
+                queue.appendleft(index)
+            else:
+                done[index] = cells[index]['total']
+                if cache is not None:
+                    cell = cells[index]
+                    cache.put(cell['tag_group'], cell['date'][:7], cell['verdict'], cell['total'],
+                              cell['closed'] and cell['complete'])
 
 
 def main():
@@ -219,9 +364,12 @@ def main():
     currentmonth = int(datetime.now().month)
 
     startTime = datetime.now()
-    index = 1
+    # run timing starts here; stage metrics are reported at the end of the run
+    get_metrics()
 
-    index_tag_full = elk_index('tag_group_stats')
+    # small stats file flushed per record; out_compression applies to out_estack and out_pretty only
+    estack_writer = EstackWriter(f'{conf.out_json}/tag_group_summary.json', elk_index('tag_group_stats'),
+                                 compression='none')
 
     # refresh tag group list
     if conf.gettagdata == 'yes':
@@ -236,6 +384,16 @@ def main():
 
     print('tag group list created')
 
+    # one search cell per month and tag group in output order
+    cells = []
+
+    # counts for closed months are reused except for the last stats_refresh_months months
+    if getattr(conf, 'statscache', 'yes') == 'yes':
+        cache = StatsCountCache()
+    else:
+        cache = None
+    refresh_months = getattr(conf, 'stats_refresh_months', 1)
+
     for year in range(startyear, currentyear+1):
         for month in range(1, 13):
 
@@ -263,45 +421,48 @@ def main():
                 enddate = f'{year}-{cleanmonth}-{cleanendday}'
 
 
-                sdate = f'{year}-{cleanmonth}'
-
-                monthly_count_dict = {}
+                # months before the current month have ended so their counts are final
+                months_ago = (currentyear * 12 + currentmonth) - (year * 12 + month)
+                closed = months_ago > 0
 
                 for tag_group in tag_groups:
-
-                    print('=' * 80)
-                    print(f'starting search for {sdate} and tag_group = {tag_group}\n')
-
-                    print('getting malware verdict counts')
-                    # submit query and get results for malware verdict counts
-
-                    mal_count = None
-
-                    while mal_count is None:
-                        mal_query = monthly_stats(tag_group, startdate, enddate, 'malware', api_key)
-                        mal_count = get_query_results(mal_query, startTime, api_key)
-
-                    mal_dailyavg = int(mal_count / endday)
-
-                    monthly_count_dict['date'] = startdate
-                    monthly_count_dict['tag_group'] = tag_group
-                    monthly_count_dict['malware_monthly_count'] = mal_count
-                    monthly_count_dict['malware_daily_average'] = mal_dailyavg
-
-                    if index == 1:
-                        with open(f'{conf.out_json}/tag_group_summary.json', 'w') as stat_file:
-                            stat_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                            stat_file.write(json.dumps(monthly_count_dict, indent=None, sort_keys=False) + "\n")
-                    else:
-                        with open(f'{conf.out_json}/tag_group_summary.json', 'a') as stat_file:
-                            stat_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                            stat_file.write(json.dumps(monthly_count_dict, indent=None, sort_keys=False) + "\n")
-
-                    index += 1
-
-    print('\nuse the curl command to load estack data to elasticSearch')
-    print('either ignore -u if no security features used or append with elasticSearch username and password\n')
-    print(f'curl -s -XPOST \'http://{conf.elastic_url_port}/_bulk\' --data-binary @tag_group_stats_json/tag_group_summary.json -H \"Content-Type: application/x-ndjson\" -u user:password\n\n')
+                    cell = {'date': startdate,
+                            'enddate': enddate,
+                            'endday': endday,
+                            'tag_group': tag_group,
+                            'verdict': 'malware',
+                            'closed': closed,
+                            }
+                    if cache is not None and closed and months_ago > refresh_months:
+                        cached_count = cache.get(tag_group, startdate[:7], 'malware')
+                        if cached_count is not None:
+                            cell['total'] = cached_count
+                    cells.append(cell)
+
+    # malware verdict counts for each month and tag group with several searches in flight
+    searches = len([cell for cell in cells if 'total' not in cell])
+    print(f'getting malware verdict counts for {searches} of {len(cells)} month and tag group cells')
+    get_metrics().count('cached_counts', len(cells) - searches)
+    try:
+        run_stats_searches(cells, startTime, api_key, estack_writer, cache)
+    except DailyQuotaExhausted as quota_message:
+        # counts already stored in the stats cache are not searched again on the rerun
+        estack_writer.close()
+        if cache is not None:
+            cache.close()
+        quota_exit(quota_message)
+
+    estack_writer.close()
+
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
+
+    # bulk load to elasticSearch or print the loader command
+    load_step(f'{conf.out_json}/tag_group_summary.json')
+
+    get_client(api_key).print_latency()
+    get_metrics().write_report('summary_stats_tag_group.py', 'tag_group_summary')
 
 if __name__ == '__main__':
     main()
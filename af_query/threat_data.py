@@ -34,9 +34,11 @@ Use at your own risk.
 import argparse
 import sys
 import os
-import json
 import time
 import csv
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
 
@@ -46,11 +48,39 @@ sys.path.insert(0, os.path.normpath(os.path.join(here, '../shared')))
 
 # script to create or update the tagdata.json list from Autofocus
 from gettagdata import tag_query
+# pooled keep-alive client shared by all Autofocus requests
+from afclient import get_client, retry_wait, quota_exit
+# raised by AFClient.post at the daily quota reserve
+from ratelimit import DailyQuotaExhausted
+# tag data indexed once per process for tag enrichment
+from tagindex import get_tag_index
+# adaptive wait between cookie results polls
+from afpoll import PollScheduler
+# local cache of sig coverage responses by sha256
+from sigcache import SigCoverageCache
+# buffered ndjson writer for the estack output files
+from estackwriter import EstackWriter
+# append-only writer for the pretty json output files
+from prettywriter import PrettyWriter, read_pretty_records
+# per query_tag search progress for --resume
+from checkpoint import Checkpoint
+# chunked concurrent elasticsearch bulk load or loader command print
+from esbulk import load_step
+# reads plain or gzip/zstd output files
+from outputfile import find_output
+# per-stage timing and quota use written as a run report
+from runmetrics import get_metrics
+# orjson or stdlib json serialization
+from jsoncodec import loads, load
+# slotted sample documents with interned tag strings
+from records import SampleRecord, intern_all, empty, empty_map
 
 # local imports for static data input
 import conf
 from filetypedata import filetypetags
 
+# serializes page parsing and output writes across concurrent chunk searches
+output_lock = threading.Lock()
 
 def elk_index():
     '''
@@ -127,7 +157,7 @@ def create_cve_list():
 
     # for a current list, should run gettagdata.py periodically
     with open('data/tagdata.json', 'r') as tag_file:
-        tag_dict = json.load(tag_file)
+        tag_dict = load(tag_file)
 
         for tag in tag_dict['_tags']:
             if 'CVE' in tag:
@@ -178,34 +208,43 @@ def multi_query(searchlist, api_key):
     print(query)
 
 
-    search_values = {"apiKey": api_key,
-                     "query": query,
+    search_values = {"query": query,
                      "size": 4000,
                      "scope": "global",
                      "type": "scan",
                      "artifactSource": "af"
                      }
 
+    submit_start = time.perf_counter()
+    good_search = False
+    attempt = 0
 
-    headers = {"Content-Type": "application/json"}
-    search_url = f'https://{conf.hostname}/api/v1.0/samples/search'
-
-    try:
-        search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-        print('Search query posted to Autofocus')
-        search.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print(search)
-        print(search.text)
-        print('\nCorrect errors and rerun the application\n')
-        sys.exit()
+    while good_search is False:
+        try:
+            search = get_client(api_key).post('samples/search', search_values)
+            print('Search query posted to Autofocus')
+            search.raise_for_status()
+            good_search = True
+        except requests.exceptions.HTTPError:
+            print(search)
+            print(search.text)
+            print('\nCorrect errors and rerun the application\n')
+            sys.exit()
+        except requests.exceptions.ConnectionError:
+            retry_wait(attempt, 'lost connection during initial query')
+            attempt += 1
+        except requests.exceptions.Timeout:
+            retry_wait(attempt, 'timed out during initial query')
+            attempt += 1
 
-    search_dict = json.loads(search.text)
+    search_dict = loads(search.content)
+    get_metrics().observe('submit', time.perf_counter() - submit_start)
 
     return search_dict
 
 
-def scantype_query_results(search_dict, start_time, query_tag, search, api_key, exploits):
+def scantype_query_results(search_dict, start_time, query_tag, search, api_key, exploits, pretty_writer,
+                           estack_writer, source_set=None, found_hashes=None, checkpoint=None):
 
     '''
     With type=scan each results post with the same cookie will return
@@ -217,6 +256,11 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
     :param start_time: when the script started - used to track run time
     :param query_tag: identifier for this script run used as estack tag
     :param search: for multi-page search to denote which 1000 block being used
+    :param pretty_writer: PrettyWriter for the nosigs pretty file shared across search blocks
+    :param estack_writer: EstackWriter for the nosigs estack file
+    :param source_set: lowercase input hashes used to ignore unexpected hits, or None
+    :param found_hashes: set updated with the lowercase hash of each parsed hit, or None
+    :param checkpoint: Checkpoint updated after each written page, or None
     :return: autofocus search results dictionary or null if no hits
     '''
 
@@ -228,34 +272,56 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
 
     search_progress = 'start'
     index = 1
+    stop_event = None
+
+    # a block searched again after a lost page skips hits written by the earlier search
+    skip_found = False
+
+    if checkpoint is not None:
+        index += checkpoint.block(search)['pages']
+        stop_event = checkpoint.stopping
+        skip_found = checkpoint.block(search).get('requery', False)
 
     running_total = []
     running_length = []
 
-    # looping across 1000 element input lists requires a file read if > 1 loops
-    if search == 1:
-        all_sample_dict = {}
-        all_sample_dict['samples'] = []
-    else:
-        with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'r') as hash_file:
-            all_sample_dict = json.load(hash_file)
+    poller = PollScheduler()
 
     while search_progress != 'FIN':
 
-        time.sleep(5)
+        poller.wait(stop_event)
+        # Ctrl-C ends the search here between pages so the checkpoint matches the output files
+        if stop_event is not None and stop_event.is_set():
+            print(f'search {search} stopped at page {index}')
+            return autofocus_results
+
+        fetch_start = time.perf_counter()
         try:
-            results_url = f'https://{conf.hostname}/api/v1.0/samples/results/' + cookie
-            headers = {"Content-Type": "application/json"}
-            results_values = {"apiKey": api_key}
-            results = requests.post(results_url, headers=headers, data=json.dumps(results_values))
+            results = get_client(api_key).post(f'samples/results/{cookie}', {})
             results.raise_for_status()
         except requests.exceptions.HTTPError:
             print(results)
             print(results.text)
             print('\nCorrect errors and rerun the application\n')
             sys.exit()
+        except requests.exceptions.ConnectTimeout:
+            # the poll never reached Autofocus so the cookie has not moved
+            print('timed out connecting for get data query - polling again')
+            get_metrics().count('results_retries')
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # Autofocus may have sent the page and moved the cookie on; never poll past a lost page
+            if checkpoint is None:
+                print(f'\nResults page for search interval {search} may have been lost')
+                print('\nCorrect errors and rerun the application\n')
+                sys.exit()
+            checkpoint.results_lost(search)
+            return autofocus_results
 
-        autofocus_results = results.json()
+        autofocus_results = loads(results.content)
+        get_metrics().observe('fetch', time.perf_counter() - fetch_start)
+        get_metrics().count('pages')
+        poller.update(autofocus_results)
 
 
         if 'total' in autofocus_results:
@@ -264,14 +330,17 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
             running_length.append(len(autofocus_results['hits']))
 
             if autofocus_results['total'] != 0:
-                # parse data and output estack json elements
-                # return is running dict of all samples for pretty json output
-                all_sample_dict = parse_sample_data(autofocus_results, start_time, index, query_tag, all_sample_dict, search, exploits)
-                with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'w') as hash_file:
-                    hash_file.write(json.dumps(all_sample_dict, indent=2, sort_keys=False) + "\n")
+                # parse data and output estack and pretty json lines elements
+                with output_lock:
+                    parse_sample_data(autofocus_results, start_time, query_tag, pretty_writer,
+                                      estack_writer, exploits, source_set, found_hashes, skip_found)
+                    estack_writer.flush()
+                    pretty_writer.flush()
+                    if checkpoint is not None:
+                        checkpoint.page_done(search, estack_writer, pretty_writer)
                 index += 1
 
-                print(f'Results update for page {index}: {query_tag}\n')
+                print(f'Results update for search {search} page {index}: {query_tag}\n')
                 print(f"samples found so far: {autofocus_results['total']}")
                 print(f"Search percent complete: {autofocus_results['af_complete_percentage']}%")
                 print(f"samples processed in this batch: {len(autofocus_results['hits'])}")
@@ -289,7 +358,10 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
                 search_progress = 'FIN'
         else:
             print('Autofocus still queuing up the search...')
-            time.sleep(5)
+
+    if checkpoint is not None:
+        with output_lock:
+            checkpoint.finish_block(search, estack_writer, pretty_writer)
 
     print('\n')
     print('=' * 80)
@@ -302,91 +374,109 @@ def scantype_query_results(search_dict, start_time, query_tag, search, api_key,
     return autofocus_results
 
 
-def parse_sample_data(autofocus_results, start_time, index, query_tag, hash_data_dict_pretty, search, exploits):
+def parse_sample_data(autofocus_results, start_time, query_tag, pretty_writer, estack_writer, exploits,
+                      source_set=None, found_hashes=None, skip_found=False):
 
     '''
     parse the AF reponse and augment the data with file type, tag, malware
     then write 2 files: pretty json and estack for bulk load into elasticsearch
     :param autofocus_results: array of data from AF multi-query response
     :param start_time: time script started; used to track run time
-    :param index: note which cycle through the search block for file w or a
     :param query_tag: identifier for this script run used as estack tag
-    :param search: for multi-page search to denote which 1000 block being used
-    :param hash_data_dict_pretty: master set of data to write out to json
-    :return: update dictionary with sample data
+    :param pretty_writer: PrettyWriter for the nosigs pretty file
+    :param estack_writer: EstackWriter for the nosigs estack file
+    :param source_set: lowercase input hashes; hits not in the set are ignored, None to keep all
+    :param found_hashes: set updated with the lowercase hash of each parsed hit, or None
+    :param skip_found: True to skip hits already in found_hashes when a block is searched again
+    :return:
     '''
 
     # mapping of tag # to text name
     malware_values = {'0': 'benign', '1': 'malware', '2': 'grayware', '3': 'phishing'}
 
-    index_tag_full = elk_index()
-
     # used to have a full view of AF tag data for data augmentation
     # for a current list, should run gettagdata.py periodically
-    with open('data/tagdata.json', 'r') as tag_file:
-        tag_dict = json.load(tag_file)
+    tag_index = get_tag_index()
 
     listsize = len(autofocus_results['hits'])
 
-    # interate through AF results to create dict key/values for each sample hash
+    # shared by every record on the page
+    query_tag = sys.intern(query_tag)
+    query_time = sys.intern(str(start_time))
+
+    # stage times summed over the page and recorded once per page
+    parse_start = time.perf_counter()
+    enrich_seconds = 0.0
+    write_seconds = 0.0
+    records = 0
+    # interate through AF results to create a compact record for each sample hash
     for listpos in range(0, listsize):
-        keyhash = autofocus_results['hits'][listpos]['_source'][conf.hashtype]
+        hit_source = autofocus_results['hits'][listpos]['_source']
+        keyhash = hit_source[conf.hashtype]
 
         # Autofocus sending back bad data - ignore if not in source hash_list
-        source_list = get_search_list()
-
-        # only for hash searches
-        #if keyhash in source_list:
-
-        hash_data_dict = {}
-
-
-        # AFoutput is json output converted to python dictionary
-        hash_data_dict['hashvalue'] = keyhash
-        hash_data_dict['sample_found'] = True
-
-        hash_data_dict['sha256hash'] = autofocus_results['hits'][listpos]['_source']['sha256']
-        hash_data_dict['create_date'] = autofocus_results['hits'][listpos]['_source']['create_date']
-        hash_data_dict['query_tag'] = query_tag
-        hash_data_dict['query_time'] = str(start_time)
+        # only for hash searches with conf.ignore_unlisted = 'yes'
+        if source_set is not None and keyhash.lower() not in source_set:
+            print('Ignoring unexpected hash found: ' + keyhash)
+            continue
+
+        # found hashes tracked as pages are parsed for the missing samples check
+        if found_hashes is not None:
+            if skip_found and keyhash.lower() in found_hashes:
+                continue
+            found_hashes.add(keyhash.lower())
+
+        # AFoutput is json output converted to a slotted record; unset fields are not written
+        hash_record = SampleRecord(hashvalue=keyhash,
+                                   sample_found=True,
+                                   sha256hash=hit_source['sha256'],
+                                   create_date=hit_source['create_date'],
+                                   query_tag=query_tag,
+                                   query_time=query_time)
 
         # initial AF query to get sample data include sha256 hash and WF verdict
         # sha256 is required for sig queries; does not support md5 or sha1
-        verdict_num = autofocus_results['hits'][listpos]['_source']['malware']
-        verdict_text = malware_values[str(verdict_num)]
-        hash_data_dict['verdict'] = verdict_text
+        verdict_num = hit_source['malware']
+        hash_record.verdict = malware_values[str(verdict_num)]
+
+        enrich_start = time.perf_counter()
 
-        if 'filetype' in autofocus_results['hits'][listpos]['_source']:
-            filetype = autofocus_results['hits'][listpos]['_source']['filetype']
-            hash_data_dict['filetype'] = filetype
+        if 'filetype' in hit_source:
+            filetype = sys.intern(hit_source['filetype'])
+            hash_record.filetype = filetype
             if filetype in filetypetags:
-                hash_data_dict['filetype_group'] = filetypetags[filetype]
+                hash_record.filetype_group = filetypetags[filetype]
             else:
-                hash_data_dict['filetype_group'] = 'NewTypeEh'
+                hash_record.filetype_group = 'NewTypeEh'
         else:
-            hash_data_dict['filetype'] = 'Unknown'
-            hash_data_dict['filetype_group'] = 'Unknown'
+            hash_record.filetype = 'Unknown'
+            hash_record.filetype_group = 'Unknown'
 
-        if 'tag' in autofocus_results['hits'][listpos]['_source']:
+        if 'tag' in hit_source:
 
-            hash_data_dict['all_tags'] = autofocus_results['hits'][listpos]['_source']['tag']
+            all_tags = intern_all(hit_source['tag'])
+            hash_record.all_tags = all_tags
+            hash_record.tag_array = empty_map
 
+            tag_matched = False
             priority_tags_public = []
             priority_tags_name = []
             tag_classes = []
-            hash_data_dict['tag_array'] = {}
-            hash_data_dict['exploit_data'] = []
+            exploit_data = []
             malware_tags = []
             campaign_tags = []
             actor_tags = []
             exploit_tags = []
 
-            for tag in hash_data_dict['all_tags']:
+            for tag in all_tags:
 
-                if 'tag_class' in tag_dict['_tags'][tag]:
+                tag_record = tag_index.get(tag)
 
-                    tag_class = tag_dict['_tags'][tag]['tag_class']
-                    tag_name = tag_dict['_tags'][tag]['tag_name']
+                if tag_record is not None and tag_record.tag_class is not None:
+
+                    tag_matched = True
+                    tag_class = tag_record.tag_class
+                    tag_name = tag_record.tag_name
                     if tag_class in ('malware_family', 'campaign', 'actor', 'exploit'):
                         priority_tags_public.append(tag)
                         priority_tags_name.append(tag_name)
@@ -407,21 +497,8 @@ def parse_sample_data(autofocus_results, start_time, index, query_tag, hash_data
                         elif tag_class == 'exploit':
                             exploit_tags.append(tag_name)
 
-                    hash_data_dict['priority_tags_public'] = priority_tags_public
-                    hash_data_dict['priority_tags_name'] = priority_tags_name
-                    hash_data_dict['tag_classes'] = tag_classes
-                    hash_data_dict['malware_tags'] = malware_tags
-                    hash_data_dict['campaign_tags'] = campaign_tags
-                    hash_data_dict['actor_tags'] = actor_tags
-                    hash_data_dict['exploit_tags'] = exploit_tags
-
-                if 'tag_groups' in tag_dict['_tags'][tag]:
-                    taggroups = []
-                    for group in tag_dict['_tags'][tag]['tag_groups']:
-                        if group not in taggroups:
-                            taggroups.append(group['tag_group_name'])
-
-                    hash_data_dict['tag_groups'] = taggroups
+                if tag_record is not None and tag_record.tag_groups is not None:
+                    hash_record.tag_groups = tag_record.tag_groups
 
                 # get CVE specific tag info and query against the fw exploit sig data
                 # note: there are many exploits tags that don't have CVE values and no way to readily correlate
@@ -442,57 +519,66 @@ def parse_sample_data(autofocus_results, start_time, index, query_tag, hash_data
                             exploit_dict['category'] = 'Unknown'
                             exploit_dict['severity'] = 'Unknown'
 
-                        hash_data_dict['exploit_data'].append(exploit_dict)
+                        exploit_data.append(exploit_dict)
 
-        # this creates a json format with first record as samples then appended json list entries
-        # proper json format to read the file in during run to append with new data
-        hash_data_dict_pretty['samples'].append(hash_data_dict)
+            hash_record.exploit_data = exploit_data or empty
 
-        # Write dict contents to running file both estack and pretty json versions
-        if index == 1 and listpos == 0 and search == 1:
-            with open(f'{conf.out_estack}/hash_data_estack_{query_tag}_nosigs.json', 'w') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
-        else:
-            with open(f'{conf.out_estack}/hash_data_estack_{query_tag}_nosigs.json', 'a') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
+            # tag class lists are only written once a tag is found in the local tag data
+            if tag_matched is True:
+                hash_record.priority_tags_public = tuple(priority_tags_public) or empty
+                hash_record.priority_tags_name = tuple(priority_tags_name) or empty
+                hash_record.tag_classes = tuple(tag_classes) or empty
+                hash_record.malware_tags = tuple(malware_tags) or empty
+                hash_record.campaign_tags = tuple(campaign_tags) or empty
+                hash_record.actor_tags = tuple(actor_tags) or empty
+                hash_record.exploit_tags = tuple(exploit_tags) or empty
+
+        write_start = time.perf_counter()
+        enrich_seconds += write_start - enrich_start
+
+        # serialized once for both outputs
+        record_text = hash_record.to_json()
+
+        # pretty json is built from the appended records at the end of the run
+        pretty_writer.write_json(record_text)
 
-        # only for hash searches
-        #else:
-        #    print('Ignoring unexpected hash found: ' + keyhash)
+        # add record contents to the running estack file
+        estack_writer.write_json(record_text)
 
-    return hash_data_dict_pretty
+        write_seconds += time.perf_counter() - write_start
+        records += 1
 
+    metrics = get_metrics()
+    metrics.observe('parse', time.perf_counter() - parse_start)
+    metrics.observe('enrich', enrich_seconds)
+    metrics.observe('write', write_seconds)
+    metrics.count('records', records)
 
-def missing_samples(query_tag, start_time):
+
+def missing_samples(query_tag, start_time, hash_list, found_hashes, estack_writer, pretty_writer):
     '''
     once the query is complete and samples found have to look for misses
-    this reads in the pretty json file to get the found list
+    input hashes are checked against the set of hashes found while parsing
     then appends the estack and pretty nosigs files with hash misses
+    :param hash_list: input hash list
+    :param found_hashes: set of lowercase hashes found by the search
+    :param estack_writer: EstackWriter for the nosigs estack file
+    :param pretty_writer: PrettyWriter for the nosigs pretty file
     :return:
     '''
 
-    index_tag_full = elk_index()
-
-    # initialize tracking dict for samples not found
-    samples_notfound_dict = {}
-    hash_list = get_search_list()
-
     missing_sample_date = start_time.strftime('%Y-%m-%dT%H:%M:%S')
-
-    # read in the full set of samples after query is complete
-    with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'r') as samplesfile:
-        samples_dict = json.load(samplesfile)
-
-    found_list = []
-    for sample in samples_dict['samples']:
-        found_list.append(sample['hashvalue'])
+    missing_count = 0
 
     for sample in hash_list:
-        if sample in found_list:
-            pass
-        else:
+        sample_key = sample.lower()
+        if sample_key not in found_hashes:
+            # add to the found set so duplicate input hashes are only reported once
+            found_hashes.add(sample_key)
+            missing_count += 1
+
+            # new tracking dict for each sample not found
+            samples_notfound_dict = {}
             samples_notfound_dict['hashvalue'] = sample
             samples_notfound_dict['sample_found'] = False
             samples_notfound_dict['query_tag'] = query_tag
@@ -501,133 +587,282 @@ def missing_samples(query_tag, start_time):
             samples_notfound_dict['verdict'] = 'No Sample Found'
 
             # Write dict contents to running file both estack and pretty json versions
-            with open(f'{conf.out_estack}/hash_data_estack_{query_tag}_nosigs.json', 'a') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(samples_notfound_dict, indent=None, sort_keys=False) + "\n")
+            estack_writer.write(samples_notfound_dict)
+            pretty_writer.write(samples_notfound_dict)
+
+    get_metrics().count('records', missing_count)
+    get_metrics().count('missing_samples', missing_count)
+    print(f'{missing_count} input hashes not found in Autofocus')
+
+
+def chunk_search(search, numsearches, search_list, start_time, query_tag, api_key, exploits, pretty_writer,
+                 estack_writer, source_set=None, found_hashes=None, checkpoint=None):
+
+    '''
+    submit the search for one block of up to 1000 search elements and
+    poll its cookie until complete
+    :param search: which 1000 block is being searched
+    :param numsearches: total number of search blocks
+    :param search_list: search elements for this block
+    :param pretty_writer: PrettyWriter for the nosigs pretty file shared across search blocks
+    :param estack_writer: EstackWriter for the nosigs estack file
+    :param source_set: lowercase input hashes used to ignore unexpected hits, or None
+    :param found_hashes: set updated with the lowercase hash of each parsed hit, or None
+    :param checkpoint: Checkpoint used to skip finished blocks and resume saved cookies, or None
+    '''
+
+    if checkpoint is not None:
+        if checkpoint.stopping.is_set():
+            return
+        block = checkpoint.block(search)
+        if block is not None and block['done'] is True:
+            print(f'\nsearch interval {search} of {numsearches} already complete')
+            return
+    else:
+        block = None
+
+    if block is not None and block['cookie'] is not None:
+        # resumed block: keep polling the saved cookie for the remaining pages
+        print(f'\nresuming search interval {search} of {numsearches} after page {block["pages"]}')
+        searchrequest = {'af_cookie': block['cookie']}
+    else:
+        requery = block is not None and block.get('requery', False)
+        if requery:
+            print(f'\nsearching interval {search} of {numsearches} again after a lost results page')
+        else:
+            print(f'\nworking with search interval {search} of {numsearches}')
+        print(f'query is sending {len(search_list)} items as search elements')
+
+        searchrequest = multi_query(search_list, api_key)
+        if checkpoint is not None:
+            checkpoint.start_block(search, searchrequest['af_cookie'], requery)
+
+    #get query results and parse output
+    scantype_query_results(searchrequest, start_time, query_tag, search, api_key, exploits, pretty_writer,
+                           estack_writer, source_set, found_hashes, checkpoint)
+
+
+def sig_coverage_query(sha256hash, api_key):
+
+    '''
+    single sig coverage lookup for a sample
+    run on the sig lookup thread pool so several requests are in flight
+    :param sha256hash: sample sha256 used in the request url
+    :param api_key: Autofocus API key
+    :return: analysis response text
+    '''
+
+    # script only returns coverage info: sections:coverage flag
+    # the attribute coverage=true also required to return coverage data
+    search_values = {"coverage": 'true',
+                     "sections": ["coverage"],
+                     }
+
+    lookup_start = time.perf_counter()
+    good_search = False
+    attempt = 0
+
+    while good_search is False:
+        try:
+            search = get_client(api_key).post(f'sample/{sha256hash}/analysis', search_values)
+            search.raise_for_status()
+            good_search = True
+        except requests.exceptions.HTTPError:
+            print(search)
+            print(search.text)
+            print('\nCorrect errors and rerun the application\n')
+            sys.exit()
+        except requests.exceptions.ConnectionError:
+            retry_wait(attempt, f'lost connection during sig coverage query for {sha256hash}')
+            attempt += 1
+        except requests.exceptions.Timeout:
+            retry_wait(attempt, f'timed out during sig coverage query for {sha256hash}')
+            attempt += 1
+
+    get_metrics().observe('sig_lookup', time.perf_counter() - lookup_start)
+
+    return search.text
+
+
+def coverage_state(coverage):
+
+    '''
+    sig state from the true/false flags in one coverage section
+    walks the decoded response instead of re-serializing it to search for 'true'
+    :param coverage: coverage section from the sig coverage response
+    :return: active if any flag is true, inactive if the flags are all false, none if no flags
+    '''
 
-            samples_dict['samples'].append(samples_notfound_dict)
+    state = 'none'
+    values = [coverage]
 
-    with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'w') as hash_file:
-        hash_file.write(json.dumps(samples_dict, indent=4, sort_keys=False) + "\n")
+    while values:
+        value = values.pop()
+        if value is True:
+            return 'active'
+        if value is False:
+            state = 'inactive'
+        elif isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, list):
+            values.extend(value)
 
+    return state
 
-def get_sig_data(query_tag, start_time):
+
+def sig_coverage_lookups(samples, api_key, cache=None):
+
+    '''
+    run sig coverage lookups for found samples with up to conf.sig_concurrency
+    requests in flight and yield results in the original sample order
+    a result is yielded as soon as it and all samples before it are done
+    fresh cached responses are used without an api request
+    :param samples: list of SampleRecords from the nosigs pretty file
+    :param api_key: Autofocus API key
+    :param cache: SigCoverageCache or None to always query
+    :return: generator of (SampleRecord, analysis response text or None, True if from cache)
+    '''
+
+    in_flight = max(getattr(conf, 'sig_concurrency', 1), 1)
+    pending = deque()
+
+    def next_result():
+        sample, future, cached_text = pending.popleft()
+        if future is not None:
+            search_text = future.result()
+            if cache is not None:
+                cache.put(sample.sha256hash, search_text)
+            return sample, search_text, False
+        return sample, cached_text, cached_text is not None
+
+    with ThreadPoolExecutor(max_workers=in_flight) as executor:
+        for sample in samples:
+            future = None
+            cached_text = None
+            if sample.sample_found is True:
+                if cache is not None:
+                    cached_text = cache.get(sample.sha256hash)
+                if cached_text is None:
+                    future = executor.submit(sig_coverage_query, sample.sha256hash, api_key)
+            pending.append((sample, future, cached_text))
+
+            # hand back finished results in order; block on the oldest when the window is full
+            while pending and (len(pending) > in_flight or pending[0][1] is None or pending[0][1].done()):
+                yield next_result()
+
+        while pending:
+            yield next_result()
+
+
+def get_sig_data(query_tag, start_time, api_key):
 
     '''
     after the initial sample data is captured then check for sig coverage
     only works with SHA256 so MD5/SHA1 input has SHA256 added from AF
-    only a single hash queried at a time since hash value in the url request
+    only a single hash queried per request since hash value in the url request
+    requests run concurrently up to conf.sig_concurrency
     a new file appended with sigs added to the archive
     :param query_tag: query descriptive tag used in elasticsearch as a filter
     :param start_time: start time of the script to capture run time
+    :param api_key: Autofocus API key
     :return:
     '''
 
     # stage 1 is the sample query and data capture stored as file nosigs
-    # that output is read in to a dict, updated, and output as sigs file
-    with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'r') as samplesfile:
-        samples_dict = json.load(samplesfile)
+    # that output is streamed in as compact records, updated, and output as sigs file
+    samples = [SampleRecord.from_dict(sample) for sample in
+               read_pretty_records(find_output(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json'))]
 
-    index_tag_full = elk_index()
-    index = 1
+    estack_writer = EstackWriter(f'{conf.out_estack}/hash_data_estack_{query_tag}_sigs.json', elk_index())
 
-    listsize = len(samples_dict['samples'])
+    listsize = len(samples)
 
-    hash_data_dict_pretty = {}
-    hash_data_dict_pretty['samples'] = []
+    pretty_writer = PrettyWriter(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json', 'samples', indent=4)
+
+    if conf.sigcache == 'yes':
+        cache = SigCoverageCache()
+    else:
+        cache = None
 
     # for sig search only lookup coverage for samples found in samples search
-    for listpos in range(0, listsize):
+    sig_results = sig_coverage_lookups(samples, api_key, cache)
+    try:
+        sig_output(sig_results, query_tag, start_time, listsize, estack_writer, pretty_writer)
+    except DailyQuotaExhausted as quota_message:
+        # lookups already made stay in the sig cache for the rerun
+        estack_writer.close()
+        pretty_writer.close()
+        if cache is not None:
+            cache.close()
+        quota_exit(quota_message)
+
+    estack_writer.close()
+    pretty_writer.close()
+
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
+
+
+def sig_output(sig_results, query_tag, start_time, listsize, estack_writer, pretty_writer):
+
+    '''
+    add sig coverage to each sample record and write the sigs output
+    :param sig_results: (record, response text, cached) in sample order from sig_coverage_lookups
+    :param listsize: number of samples for the progress messages
+    '''
+
+    for listpos, (hash_record, search_text, cached) in enumerate(sig_results):
 
-        hash_data_dict = samples_dict['samples'][listpos]
         hash_num = listpos + 1
 
-        if samples_dict['samples'][listpos]['sample_found'] is True:
+        if search_text is not None:
 
-            sha256hash = hash_data_dict['sha256hash']
+            sha256hash = hash_record.sha256hash
 
-            print(f"\ngetting sig coverage for {hash_num} of {listsize}: {query_tag}")
+            print(f"\ngot sig coverage for {hash_num} of {listsize}: {query_tag}")
             print(f'hash: {sha256hash}')
 
-            # script only returns coverage info: sections:coverage flag
-            # the attribute coverage=true also required to return coverage data
-            search_values = {"apiKey": api_key,
-                             "coverage": 'true',
-                             "sections": ["coverage"],
-                             }
-
-            headers = {"Content-Type": "application/json"}
-            search_url = f'https://{conf.hostname}/api/v1.0/sample/{sha256hash}/analysis'
-
-            try:
-                search = requests.post(search_url, headers=headers,
-                                       data=json.dumps(search_values))
-                search.raise_for_status()
-            except requests.exceptions.HTTPError:
-                print(search)
-                print(search.text)
-                print('\nCorrect errors and rerun the application\n')
-                sys.exit()
-
             # this is a single request-response interaction
             # no cookie and updated checks required
-            results_analysis = json.loads(search.text)
+            results_analysis = loads(search_text)
 
             # sig types with coverage data to be captured
             sigtypes = ['dns_sig', 'wf_av_sig', 'fileurl_sig']
 
             for stype in sigtypes:
                 # add the full response to the doc
-                hash_data_dict[stype] = results_analysis['coverage'][stype]
+                setattr(hash_record, stype, results_analysis['coverage'][stype])
 
                 # check sig state by type and add to doc
-                sig_state = f'{stype}_sig_state'
-                # convert to string for quick text search
-                sigstring = json.dumps(results_analysis['coverage'][stype])
-                if sigstring.find('true') != -1:
-                    hash_data_dict[sig_state] = 'active'
-                elif sigstring.find('true') == -1 and sigstring.find('false') != -1:
-                    hash_data_dict[sig_state] = 'inactive'
-                else:
-                    hash_data_dict[sig_state] = 'none'
+                setattr(hash_record, f'{stype}_sig_state', coverage_state(results_analysis['coverage'][stype]))
 
             # set doc value for any sig coverage as active, inactive, none
-            if search.text.find('true') != -1:
-                hash_data_dict['sig_state_all'] = 'active'
-            elif search.text.find('true') == -1 and search.text.find('false') != -1:
-                hash_data_dict['sig_state_all'] = 'inactive'
+            if search_text.find('true') != -1:
+                hash_record.sig_state_all = 'active'
+            elif search_text.find('true') == -1 and search_text.find('false') != -1:
+                hash_record.sig_state_all = 'inactive'
             else:
-                hash_data_dict['sig_state_all'] = 'none'
-
-            print('Sig coverage search complete')
-            minute_pts_rem =\
-                results_analysis['bucket_info']['minute_points_remaining']
-            daily_pts_rem =\
-                results_analysis['bucket_info']['daily_points_remaining']
-            print(f'AF quota update:  {minute_pts_rem} minute points and {daily_pts_rem} daily points remaining')
+                hash_record.sig_state_all = 'none'
+
+            if cached is True:
+                print('Sig coverage from local cache')
+                get_metrics().count('sig_cache_hits')
+            else:
+                print('Sig coverage search complete')
+                minute_pts_rem =\
+                    results_analysis['bucket_info']['minute_points_remaining']
+                daily_pts_rem =\
+                    results_analysis['bucket_info']['daily_points_remaining']
+                print(f'AF quota update:  {minute_pts_rem} minute points and {daily_pts_rem} daily points remaining')
             elapsedtime = datetime.now() - start_time
             print(f'Elasped run time is {elapsedtime}')
 
-        hash_data_dict_pretty['samples'].append(hash_data_dict)
-
-        # Write dict contents to running file both estack and pretty json versions
-        if index == 1 and listpos == 0:
-            with open(f'{conf.out_estack}/hash_data_estack_{query_tag}_sigs.json', 'w') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
-
-            with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json', 'w') as hash_file:
-                hash_file.write(json.dumps(hash_data_dict_pretty, indent=4, sort_keys=False) + "\n")
-        else:
-            with open(f'{conf.out_estack}/hash_data_estack_{query_tag}_sigs.json', 'a') as hash_file:
-                hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-                hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
-
-        index += 1
-
-
-    with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json', 'w') as hash_file:
-                    hash_file.write(json.dumps(hash_data_dict_pretty, indent=4, sort_keys=False) + "\n")
+        # Write record contents to running file both estack and pretty json versions
+        record_text = hash_record.to_json()
+        estack_writer.write_json(record_text)
+        pretty_writer.write_json(record_text)
+        get_metrics().count('sig_records')
 
 
 def quick_stats(query_tag):
@@ -647,18 +882,13 @@ def quick_stats(query_tag):
     for value in hash_count_values:
         hash_counters[value] = 0
 
-    # get the full json output file will all post-run sample data
-    with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json', 'r') as samplesfile:
-        samples_dict = json.load(samplesfile)
-
-
-    listsize = len(samples_dict['samples'])
-    hash_counters['total samples'] = listsize
+    # stream the full json output file with all post-run sample data
+    samples = read_pretty_records(find_output(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_sigs.json'))
 
     # iterate through each sample dict in the json samples list
-    for listpos in range(0, listsize):
+    for sample_data in samples:
 
-        sample_data = samples_dict['samples'][listpos]
+        hash_counters['total samples'] += 1
 
         # counter updates for WF verdicts
         if sample_data['verdict'] == 'malware':
@@ -705,6 +935,8 @@ def main():
     # name must match a variable in the .meta-cnc file directly
     parser = argparse.ArgumentParser()
     parser.add_argument("-k", "--api_key", help="Autofocus API key", type=str)
+    parser.add_argument("-r", "--resume", help="continue an interrupted search from its checkpoint",
+                        action="store_true")
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -719,12 +951,15 @@ def main():
 
     # for longer lists may have to break list in 1000 size pieces
     # for autofocus type queries on do a single search
-    numsearches = 1
+    search_blocks = [[]]
 
     query_tag = input('Enter brief tag name for this data: ')
     start_time = datetime.now()
-    listend = -1
+    # run timing starts here; stage metrics are reported at the end of the run
+    get_metrics()
     ok_to_get_sigs = True
+    source_set = None
+    found_hashes = set()
 
     if conf.get_exploits is True:
         exploit_dict = clean_exploit_data()
@@ -754,42 +989,102 @@ def main():
         if conf.querytype in ['hash', 'threat', 'domain']:
             # read items list from file
             search_list_all = get_search_list()
-            listlength = len(search_list_all)
-            numsearches = int(listlength / 1000) + 1
-
-        for search in range(1, numsearches + 1):
-        #submit bulk query for sample data to AF
-
-            print(f'\nworking with search interval {search} of {numsearches}')
-            liststart = listend + 1
-            listend += 1000
-
-            search_list = search_list_all[liststart:listend]
-            print(f'query is sending {len(search_list)} items as search elements')
-
-            searchrequest = multi_query(search_list, api_key)
-
-            #get query results and parse output
-            scantype_query_results(searchrequest, start_time, query_tag, search, api_key, exploit_dict)
-
-        # check that the output sigs file exists if AF hits 1= 0
-        # if no file, check that hashtype in conf.py matches hashlist.txt type
+            search_blocks = [search_list_all[liststart:liststart + 1000]
+                             for liststart in range(0, len(search_list_all), 1000)] or [[]]
+
+        # input hashes read once into a set for O(1) checks of each hit
+        if conf.querytype == 'hash' and conf.ignore_unlisted == 'yes':
+            source_set = {sample.lower() for sample in search_list_all}
+
+        numsearches = len(search_blocks)
+
+        # search progress is saved after each page for --resume
+        checkpoint = Checkpoint('hash_data', query_tag)
+        estack_file = f'{conf.out_estack}/hash_data_estack_{query_tag}_nosigs.json'
+        pretty_file = f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json'
+
+        if args.resume is True and checkpoint.exists():
+            checkpoint.load()
+            if checkpoint.state['numsearches'] != numsearches:
+                print(f'\nCheckpoint {checkpoint.filename} has {checkpoint.state["numsearches"]} search blocks '
+                      f'but the current search list has {numsearches}')
+                print('Restore the original search list or run without --resume\n')
+                sys.exit(1)
+            print(f'\nResuming {query_tag} from {checkpoint.filename}')
+            start_time = checkpoint.start_time()
+            # drop any partial page written after the last checkpoint then append
+            checkpoint.truncate_outputs()
+            estack_writer = EstackWriter(estack_file, elk_index(), mode='a')
+            pretty_writer = PrettyWriter(pretty_file, 'samples', mode='a')
+            checkpoint.restore_records(estack_writer, pretty_writer)
+            for record in pretty_writer.records_written():
+                if record.get('sample_found') is True:
+                    found_hashes.add(record['hashvalue'].lower())
+        else:
+            if args.resume is True:
+                print(f'\nNo checkpoint found for {query_tag}: starting a new search')
+            checkpoint.start(start_time, numsearches)
+            # one estack file held open for all search blocks and missing samples
+            estack_writer = EstackWriter(estack_file, elk_index())
+            pretty_writer = PrettyWriter(pretty_file, 'samples')
+
+        # Ctrl-C stops at a page boundary only during the search
+        checkpoint.install_stop_handler()
         try:
-            with open(f'{conf.out_pretty}/hash_data_pretty_{query_tag}_nosigs.json', 'r'):
-                pass
-        except IOError as nofile_error:
-            print(nofile_error)
-            print(f'Unable to open out_pretty/hash_data_pretty_{query_tag}_nosigs.json')
+            #submit bulk query for sample data to AF
+            # up to conf.search_concurrency blocks are searched and polled at the same time
+            concurrency = min(getattr(conf, 'search_concurrency', 1), numsearches)
+            if concurrency > 1:
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    futures = [executor.submit(chunk_search, search, numsearches, search_list, start_time,
+                                               query_tag, api_key, exploit_dict, pretty_writer,
+                                               estack_writer, source_set, found_hashes, checkpoint)
+                               for search, search_list in enumerate(search_blocks, 1)]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except BaseException:
+                        # running blocks stop at their next page and blocks not yet started are dropped
+                        checkpoint.stopping.set()
+                        executor.shutdown(cancel_futures=True)
+                        raise
+            else:
+                for search, search_list in enumerate(search_blocks, 1):
+                    chunk_search(search, numsearches, search_list, start_time,
+                                 query_tag, api_key, exploit_dict, pretty_writer,
+                                 estack_writer, source_set, found_hashes, checkpoint)
+        except DailyQuotaExhausted as quota_message:
+            # writers are closed below and the run exits through the checkpoint
+            checkpoint.quota_exhausted(quota_message)
+        finally:
+            checkpoint.restore_stop_handler()
+
+        if checkpoint.stopping.is_set():
+            # keep the json lines intermediate so the resumed run can append to it
+            estack_writer.close()
+            pretty_writer.close(materialize=False)
+            get_metrics().write_report('threat_data.py', query_tag)
+            checkpoint.exit_stopped('threat_data.py')
+
+        # check that the search found samples if AF hits 1= 0
+        # if none, check that hashtype in conf.py matches hashlist.txt type
+        if pretty_writer.records == 0:
+            print(f'No samples found for out_pretty/hash_data_pretty_{query_tag}_nosigs.json')
             print('This file is output from the initial sample search and read in to create a sig coverage output')
             print('If hits are expected check that the hashtype in conf.py matches the hashes in hash_list.txt')
             ok_to_get_sigs = False
 
         # find AF sample misses and add to the estack json file as not found
         if conf.querytype == 'hash':
-            missing_samples(query_tag, start_time)
+            missing_samples(query_tag, start_time, search_list_all, found_hashes, estack_writer, pretty_writer)
+
+        # pretty json output is written once from the appended records
+        estack_writer.close()
+        pretty_writer.close()
+        checkpoint.remove()
 
     if conf.getsigdata == 'yes' and ok_to_get_sigs is True:
-            get_sig_data(query_tag, start_time)
+            get_sig_data(query_tag, start_time, api_key)
 
     if conf.querytype == 'autofocus':
             print(conf.af_query)
@@ -798,10 +1093,11 @@ def main():
     if conf.querytype == 'hash' and conf.getsigdata == 'yes':
         quick_stats(query_tag)
 
-    # print out the elasticSearch bulk load based on the tag and thus filename
-    print('\nuse the curl command to load estack data to elasticSearch')
-    print('either ignore -u if no security features used or append with elasticSearch username and password\n')
-    print(f'curl -s -XPOST \'http://{conf.elastic_url_port}/_bulk\' --data-binary @out_estack/hash_data_estack_{query_tag}_nosigs.json -H \"Content-Type: application/x-ndjson\" -u user:password\n\n')
+    get_client(api_key).print_latency()
+    get_metrics().write_report('threat_data.py', query_tag)
+
+    # bulk load to elasticSearch or print the loader command based on the tag and thus filename
+    load_step(f'{conf.out_estack}/hash_data_estack_{query_tag}_nosigs.json')
 
 if __name__ == '__main__':
     main()
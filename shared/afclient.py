@@ -0,0 +1,223 @@
+"""
+shared Autofocus api client used by the af_query scripts
+a single requests session keeps connections to conf.hostname alive in a
+bounded pool so repeat searches, result polls, and sig lookups reuse sockets
+instead of a new TCP+TLS handshake per post
+"""
+import sys
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+import conf
+from ratelimit import QuotaLimiter
+from runmetrics import get_metrics
+
+# (connect, read) timeouts in seconds if conf.py does not set af_timeouts
+default_timeouts = {'search': (10, 60),
+                    'results': (10, 120),
+                    'analysis': (10, 60),
+                    'tags': (10, 60),
+                    }
+
+# one client per api key for the life of the process
+clients = {}
+clients_lock = threading.Lock()
+
+
+def endpoint_name(endpoint):
+
+    '''
+    map an api path to the endpoint group used for timeouts and latency stats
+    :param endpoint: api path after /api/v1.0/ such as samples/results/{cookie}
+    :return: endpoint group name
+    '''
+
+    parts = endpoint.strip('/').split('/')
+    if parts[0] == 'tags':
+        return 'tags'
+    if parts[0] == 'sample' and parts[-1] == 'analysis':
+        return 'analysis'
+    if len(parts) > 1 and parts[1] == 'results':
+        return 'results'
+
+    return 'search'
+
+
+def quota_exceeded(response):
+
+    '''
+    check if the api rejected a request for the points quota
+    :param response: requests response
+    :return: True if the request should be resent after the bucket refills
+    '''
+
+    if response.status_code == 429:
+        return True
+    if response.status_code == 409:
+        text = response.text.lower()
+        return 'bucket' in text or 'quota' in text
+
+    return False
+
+
+def retry_wait(attempt, description):
+
+    '''
+    back off before resending a request that lost its connection or timed out
+    exits through the usual error path once conf.connection_retries are used up
+    :param attempt: retries already made for this request, starting at 0
+    :param description: what failed, such as timed out during initial query
+    '''
+
+    retries = getattr(conf, 'connection_retries', 5)
+    if attempt >= retries:
+        print(f'\n{description} - giving up after {retries} retries')
+        print('\nCorrect errors and rerun the application\n')
+        sys.exit()
+
+    wait = getattr(conf, 'connection_backoff', 1) * 2 ** attempt
+    print(f'{description} - trying again in {wait} seconds')
+    get_metrics().count('connection_retries')
+    time.sleep(wait)
+
+
+def quota_exit(quota_message):
+
+    '''
+    exit from the main thread when a step that can't be resumed runs into the daily quota reserve
+    close the step's output files before calling
+    :param quota_message: DailyQuotaExhausted raised by AFClient.post
+    '''
+
+    print(f'\nStopping before the Autofocus daily quota runs out: {quota_message}')
+    print('Rerun the application once the daily points refresh\n')
+    sys.exit()
+
+
+class AFClient:
+
+    '''
+    pooled keep-alive http client for the Autofocus api
+    records per-request latency by endpoint group
+    every request draws from the shared points quota limiter
+    '''
+
+    def __init__(self, api_key, hostname=None, pool_size=None, timeouts=None):
+
+        self.api_key = api_key
+        self.hostname = hostname or conf.hostname
+        # a hostname with a scheme, such as a local mock server on http, is used as given
+        if self.hostname.startswith(('http://', 'https://')):
+            self.base_url = f'{self.hostname.rstrip("/")}/api/v1.0'
+        else:
+            self.base_url = f'https://{self.hostname}/api/v1.0'
+        pool_size = pool_size or getattr(conf, 'af_pool_size', 10)
+        self.timeouts = dict(default_timeouts)
+        self.timeouts.update(timeouts or getattr(conf, 'af_timeouts', {}))
+
+        # bounded pool; block=True makes extra threads wait for a free socket
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+        self.latency = {}
+        self.lock = threading.Lock()
+        self.limiter = QuotaLimiter()
+        get_metrics().add_limiter(self.limiter)
+        self.quota_retries = getattr(conf, 'quota_retries', 5)
+
+    def post(self, endpoint, values):
+
+        '''
+        post a json request to the api with the api key added
+        caller checks raise_for_status() same as with a bare requests.post
+        DailyQuotaExhausted is raised to the caller so the main thread can save progress and exit
+        :param endpoint: api path after /api/v1.0/ such as samples/search
+        :param values: request body dict without the apiKey
+        :return: requests response
+        '''
+
+        name = endpoint_name(endpoint)
+        body = json.dumps(dict(values, apiKey=self.api_key))
+
+        for attempt in range(self.quota_retries + 1):
+            self.limiter.acquire()
+
+            response = None
+            start = time.perf_counter()
+            try:
+                response = self.session.post(f'{self.base_url}/{endpoint}', data=body,
+                                             timeout=self.timeouts[name])
+            finally:
+                self.record_latency(name, time.perf_counter() - start)
+                self.limiter.release(response.text if response is not None else None)
+
+            # over the minute quota; wait for the bucket to refill and resend
+            if quota_exceeded(response) and attempt < self.quota_retries:
+                print(f'Autofocus minute quota exceeded for {name} request - waiting for refill')
+                get_metrics().count('quota_retries')
+                self.limiter.minute_exhausted()
+                continue
+
+            if response.status_code >= 400:
+                get_metrics().count('http_errors')
+
+            return response
+
+    def record_latency(self, name, seconds):
+
+        with self.lock:
+            self.latency.setdefault(name, []).append(seconds)
+        get_metrics().observe_http(name, seconds)
+
+    def latency_summary(self):
+
+        '''
+        per endpoint request count and latency stats in seconds
+        :return: dict of endpoint group to count, mean, max
+        '''
+
+        summary = {}
+        with self.lock:
+            for name, values in self.latency.items():
+                summary[name] = {'count': len(values),
+                                 'mean': sum(values) / len(values),
+                                 'max': max(values)}
+
+        return summary
+
+    def print_latency(self):
+
+        summary = self.latency_summary()
+        if not summary:
+            return
+
+        print('-' * 80)
+        print('Autofocus request latency by endpoint')
+        for name, stats in sorted(summary.items()):
+            print(f"{name}: {stats['count']} requests, mean {stats['mean']:.3f}s, max {stats['max']:.3f}s")
+        print('-' * 80)
+
+    def close(self):
+
+        self.session.close()
+
+
+def get_client(api_key):
+
+    '''
+    return the shared client for this api key, creating it on first use
+    :param api_key: Autofocus API key
+    :return: AFClient instance
+    '''
+
+    with clients_lock:
+        if api_key not in clients:
+            clients[api_key] = AFClient(api_key)
+
+    return clients[api_key]
@@ -0,0 +1,93 @@
+"""
+adaptive wait between Autofocus cookie results polls
+replaces the fixed 5 second sleep: poll again quickly while a scan search
+is handing out new pages and back off otherwise, never sleeping past the
+estimated completion time from af_complete_percentage
+"""
+import time
+
+import conf
+from runmetrics import get_metrics
+
+
+class PollScheduler:
+
+    '''
+    tracks progress across results polls for one cookie and sets the wait
+    before the next poll between conf.poll_min_interval and conf.poll_max_interval
+    only type=scan searches hand out a new page per poll; other searches return
+    the same hits each time so they always back off
+    '''
+
+    def __init__(self, min_interval=None, max_interval=None, scan=True):
+
+        if min_interval is None:
+            min_interval = getattr(conf, 'poll_min_interval', 0.5)
+        if max_interval is None:
+            max_interval = getattr(conf, 'poll_max_interval', 30)
+
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.scan = scan
+        self.interval = self.min_interval
+        self.last_percent = None
+        self.last_time = None
+        self.polls = 0
+        self.waited = 0.0
+
+    def wait(self, stop_event=None):
+
+        '''
+        sleep for the current interval before the next results poll
+        :param stop_event: optional threading.Event that ends the wait early
+        '''
+
+        start = time.perf_counter()
+        if stop_event is not None:
+            stop_event.wait(self.interval)
+        else:
+            time.sleep(self.interval)
+        self.waited += self.interval
+        get_metrics().observe('poll_wait', time.perf_counter() - start)
+
+    def update(self, autofocus_results):
+
+        '''
+        set the next interval from the latest results response
+        :param autofocus_results: json dict from the results/{cookie} post
+        :return: next wait interval in seconds
+        '''
+
+        now = time.monotonic()
+        self.polls += 1
+
+        # search not started yet so back off until Autofocus has it queued
+        if 'total' not in autofocus_results:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self.last_time = now
+            return self.interval
+
+        if autofocus_results.get('af_in_progress') is False:
+            self.interval = self.min_interval
+            return self.interval
+
+        percent = autofocus_results.get('af_complete_percentage', 0)
+        hits = len(autofocus_results.get('hits', []))
+
+        # a scan search just handed out a page so the next one may be ready now
+        if self.scan and hits > 0:
+            interval = self.min_interval
+        else:
+            interval = self.interval * 2
+
+        # don't sleep past when the search is expected to complete
+        if self.last_percent is not None and percent > self.last_percent and now > self.last_time:
+            rate = (percent - self.last_percent) / (now - self.last_time)
+            remaining = (100 - percent) / rate
+            interval = min(interval, remaining)
+
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.last_percent = percent
+        self.last_time = now
+
+        return self.interval
@@ -0,0 +1,215 @@
+"""
+checkpoint and resume for long scan searches
+after each results page is written the checkpoint file for the query_tag
+records the search cookie, pages processed per 1000-hash search block, and
+the output file offsets; a --resume run truncates anything written after
+that point and continues polling the saved cookies
+"""
+import os
+import sys
+import signal
+import threading
+from datetime import datetime
+
+import conf
+# orjson or stdlib json serialization
+from jsoncodec import load, dumps_pretty
+
+
+class Checkpoint:
+
+    '''
+    per query_tag search progress saved as json in conf.checkpoint_dir
+    '''
+
+    def __init__(self, script_name, query_tag):
+
+        checkpoint_dir = getattr(conf, 'checkpoint_dir', 'checkpoints')
+        if os.path.isdir(checkpoint_dir) is False:
+            os.mkdir(checkpoint_dir, mode=0o755)
+
+        self.filename = f'{checkpoint_dir}/{script_name}_{query_tag}.json'
+        self.state = {'query_tag': query_tag,
+                      'start_time': None,
+                      'numsearches': None,
+                      'blocks': {},
+                      'outputs': {},
+                      }
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Ctrl-C handler in place before install_stop_handler
+        self.previous_handler = None
+
+    def exists(self):
+
+        return os.path.isfile(self.filename)
+
+    def load(self):
+
+        with open(self.filename, 'r') as checkpoint_file:
+            self.state = load(checkpoint_file)
+
+    def save(self):
+
+        '''
+        write the checkpoint atomically so a crash never leaves a partial file
+        '''
+
+        temp_filename = f'{self.filename}.tmp'
+        with open(temp_filename, 'w') as checkpoint_file:
+            checkpoint_file.write(dumps_pretty(self.state, 2) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_filename, self.filename)
+
+    def remove(self):
+
+        if self.exists():
+            os.remove(self.filename)
+
+    def start(self, start_time, numsearches):
+
+        self.state['start_time'] = start_time.strftime('%Y-%m-%d %H:%M:%S.%f')
+        self.state['numsearches'] = numsearches
+        self.save()
+
+    def start_time(self):
+
+        return datetime.strptime(self.state['start_time'], '%Y-%m-%d %H:%M:%S.%f')
+
+    def block(self, search):
+
+        '''
+        :param search: which 1000 block is being searched
+        :return: dict with cookie, pages, done or None if the block was not started
+        '''
+
+        return self.state['blocks'].get(str(search))
+
+    def start_block(self, search, cookie, requery=False):
+
+        '''
+        :param search: which 1000 block is being searched
+        :param cookie: search cookie to poll for the block's results
+        :param requery: True when the block is searched again after a lost results page
+        '''
+
+        with self.lock:
+            self.state['blocks'][str(search)] = {'cookie': cookie, 'pages': 0, 'done': False, 'requery': requery}
+            self.save()
+
+    def requery_block(self, search):
+
+        '''
+        a results page was lost so the saved cookie can't be polled again
+        the block is searched again on --resume and hits already written are skipped
+        :param search: which 1000 block lost a page
+        '''
+
+        with self.lock:
+            self.state['blocks'][str(search)] = {'cookie': None, 'pages': 0, 'done': False, 'requery': True}
+            self.save()
+
+    def results_lost(self, search):
+
+        '''
+        stop the search after a results poll that may have been answered but not received
+        :param search: which 1000 block lost a page
+        '''
+
+        print(f'\nResults page for search interval {search} may have been lost - stopping the search')
+        print('The interval is searched again on --resume and hits already written are skipped')
+        self.requery_block(search)
+        self.stopping.set()
+
+    def quota_exhausted(self, quota_message):
+
+        '''
+        stop the search at the daily quota reserve so it can be resumed once the points refresh
+        :param quota_message: DailyQuotaExhausted raised by AFClient.post
+        '''
+
+        print(f'\nStopping before the Autofocus daily quota runs out: {quota_message}')
+        print('Resume once the daily points refresh')
+        self.stopping.set()
+
+    def page_done(self, search, *writers):
+
+        '''
+        record a durable point once a page has been written and flushed
+        :param search: which 1000 block the page belongs to
+        :param writers: output writers with path, offset(), and records
+        '''
+
+        with self.lock:
+            self.state['blocks'][str(search)]['pages'] += 1
+            self.record_outputs(writers)
+            self.save()
+
+    def finish_block(self, search, *writers):
+
+        with self.lock:
+            self.state['blocks'][str(search)]['done'] = True
+            self.record_outputs(writers)
+            self.save()
+
+    def record_outputs(self, writers):
+
+        for writer in writers:
+            self.state['outputs'][writer.path] = {'offset': writer.offset(), 'records': writer.records}
+
+    def truncate_outputs(self):
+
+        '''
+        truncate outputs back to the last durable point
+        call before the writers are reopened in append mode
+        '''
+
+        for path, output in self.state['outputs'].items():
+            if os.path.isfile(path):
+                with open(path, 'r+b') as output_file:
+                    output_file.truncate(output['offset'])
+
+    def restore_records(self, *writers):
+
+        '''
+        :param writers: writers reopened for append after truncation
+        '''
+
+        for writer in writers:
+            if writer.path in self.state['outputs']:
+                writer.records = self.state['outputs'][writer.path]['records']
+
+    def install_stop_handler(self):
+
+        '''
+        Ctrl-C stops the search at the next page boundary so the checkpoint stays consistent
+        a second Ctrl-C exits immediately; call restore_stop_handler when the search ends
+        '''
+
+        def stop_handler(signum, frame):
+            print('\nStopping after the current results page - Ctrl-C again to exit now')
+            self.stopping.set()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        previous_handler = signal.signal(signal.SIGINT, stop_handler)
+        # None when the handler was not set from python
+        self.previous_handler = previous_handler if previous_handler is not None else signal.default_int_handler
+
+    def restore_stop_handler(self):
+
+        '''
+        put back the Ctrl-C handler from before the search so the sig, missing sample,
+        and load steps exit on the first Ctrl-C
+        '''
+
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGINT, self.previous_handler)
+            self.previous_handler = None
+
+    def exit_stopped(self, script_name):
+
+        self.save()
+        print(f'\nProgress saved to {self.filename}')
+        print(f'Rerun {script_name} with --resume and the same tag name to continue\n')
+        sys.exit(1)
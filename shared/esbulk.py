@@ -0,0 +1,248 @@
+"""
+parallel elasticsearch bulk loader for the estack output files
+the ndjson file is streamed in size-bounded _bulk requests over several
+concurrent connections instead of one request for the whole file, so large
+runs stay under the elasticsearch http.max_content_length limit
+"""
+import sys
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import conf
+# plain or gzip/zstd estack files are read as a stream
+from outputfile import open_input, find_output
+
+# per-item bulk statuses that are retried; elasticsearch rejects with 429 when its write queue is full
+retry_statuses = {429, 503}
+
+
+def bulk_chunks(filename, chunk_bytes):
+
+    '''
+    read action and document line pairs from an estack file into size-bounded chunks
+    a single pair larger than chunk_bytes is sent on its own
+    :param filename: estack ndjson file name; .gz and .zst files are decompressed as read
+    :param chunk_bytes: max request body size in bytes
+    :return: generator of lists of (action, document) line pairs
+    '''
+
+    chunk = []
+    size = 0
+
+    with open_input(filename, binary=True) as estack_file:
+        for action in estack_file:
+            if not action.strip():
+                continue
+            document = estack_file.readline()
+            pair_size = len(action) + len(document)
+            if chunk and size + pair_size > chunk_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((action, document))
+            size += pair_size
+
+    if chunk:
+        yield chunk
+
+
+class BulkLoader:
+
+    '''
+    concurrent chunked _bulk loader with backoff on 429 and rejected items
+    '''
+
+    def __init__(self, url_port=None, auth=None, concurrency=None, chunk_bytes=None, retries=None):
+
+        '''
+        :param url_port: elasticsearch host:port; defaults to conf.elastic_url_port
+        :param auth: 'username:password' or None for no security features
+        :param concurrency: number of bulk requests in flight
+        :param chunk_bytes: max bulk request body size in bytes
+        :param retries: times a rejected chunk or item is resent
+        '''
+
+        if url_port is None:
+            url_port = conf.elastic_url_port
+        if auth is None:
+            auth = getattr(conf, 'elastic_auth', '')
+        if concurrency is None:
+            concurrency = getattr(conf, 'elastic_bulk_concurrency', 4)
+        if chunk_bytes is None:
+            chunk_bytes = getattr(conf, 'elastic_bulk_bytes', 10 * 1024 * 1024)
+        if retries is None:
+            retries = getattr(conf, 'elastic_bulk_retries', 5)
+
+        if not url_port.startswith('http'):
+            url_port = f'http://{url_port}'
+        self.url = f'{url_port}/_bulk'
+        self.concurrency = max(concurrency, 1)
+        self.chunk_bytes = chunk_bytes
+        self.retries = retries
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency))
+        self.session.headers['Content-Type'] = 'application/x-ndjson'
+        if auth:
+            self.session.auth = tuple(auth.split(':', 1))
+
+        self.indexed = 0
+        self.failed = 0
+        self.retried = 0
+        self.errors = []
+
+    def backoff(self, attempt):
+
+        '''
+        wait before a retry: 1, 2, 4 ... seconds up to 30
+        '''
+
+        time.sleep(min(2 ** attempt, 30))
+
+    def post_chunk(self, chunk):
+
+        '''
+        send one chunk and resend rejected items with backoff
+        :param chunk: list of (action, document) line pairs
+        :return: (indexed, failed, retried, error reasons) for the chunk
+        '''
+
+        indexed = 0
+        failed = 0
+        retried = 0
+        errors = []
+        attempt = 0
+
+        while chunk:
+            try:
+                response = self.session.post(self.url, data=b''.join(action + document for action, document in chunk))
+            except requests.exceptions.ConnectionError as err:
+                response = None
+                reason = str(err)
+
+            if response is not None and response.status_code not in retry_statuses:
+                if response.status_code >= 400:
+                    print(response)
+                    print(response.text)
+                    print('\nCorrect errors and rerun the bulk load\n')
+                    sys.exit()
+
+                result = response.json()
+                if result.get('errors') is not True:
+                    return indexed + len(chunk), failed, retried, errors
+
+                # keep only the items elasticsearch rejected for back pressure
+                rejected = []
+                for pair, item in zip(chunk, result['items']):
+                    status = next(iter(item.values()))
+                    if status['status'] in retry_statuses:
+                        rejected.append(pair)
+                    elif status['status'] >= 300:
+                        failed += 1
+                        if len(errors) < 5:
+                            errors.append(status.get('error'))
+                    else:
+                        indexed += 1
+                chunk = rejected
+                reason = 'rejected items'
+            elif response is not None:
+                reason = f'http {response.status_code}'
+
+            if not chunk:
+                break
+
+            attempt += 1
+            if attempt > self.retries:
+                failed += len(chunk)
+                errors.append(f'{len(chunk)} documents not loaded after {self.retries} retries: {reason}')
+                break
+
+            retried += len(chunk)
+            self.backoff(attempt - 1)
+
+        return indexed, failed, retried, errors
+
+    def record(self, result):
+
+        indexed, failed, retried, errors = result
+        self.indexed += indexed
+        self.failed += failed
+        self.retried += retried
+        # only the first few error reasons are kept for the summary
+        for error in errors:
+            if len(self.errors) < 5:
+                self.errors.append(error)
+
+    def load(self, filename):
+
+        '''
+        bulk load an estack file with up to self.concurrency requests in flight
+        :param filename: estack ndjson file name
+        :return: documents indexed
+        '''
+
+        start_time = datetime.now()
+        start_indexed = self.indexed
+        print(f'\nbulk loading {filename} to {self.url}')
+
+        in_flight = deque()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for chunk in bulk_chunks(filename, self.chunk_bytes):
+                # bounded so only a few chunks are held in memory at a time
+                if len(in_flight) >= self.concurrency * 2:
+                    self.record(in_flight.popleft().result())
+                in_flight.append(executor.submit(self.post_chunk, chunk))
+
+            while in_flight:
+                self.record(in_flight.popleft().result())
+
+        elapsed = (datetime.now() - start_time).total_seconds()
+        self.print_stats(elapsed, self.indexed - start_indexed)
+
+        return self.indexed - start_indexed
+
+    def print_stats(self, elapsed, indexed):
+
+        '''
+        totals are for all files loaded so far; the rate is for the last file
+        '''
+
+        rate = indexed / elapsed if elapsed > 0 else 0
+        print(f'documents indexed: {self.indexed}')
+        print(f'documents failed: {self.failed}')
+        print(f'documents retried: {self.retried}')
+        print(f'bulk load time: {elapsed:.1f} seconds ({rate:.0f} docs/sec)')
+        for error in self.errors:
+            print(f'bulk error: {json.dumps(error)}')
+
+    def close(self):
+
+        self.session.close()
+
+
+def load_step(filename):
+
+    '''
+    post-run step: bulk load the estack file when conf.elastic_load is yes,
+    otherwise print the loader command for the file
+    :param filename: estack ndjson file name without a compression suffix
+    '''
+
+    filename = find_output(filename)
+
+    if getattr(conf, 'elastic_load', 'no') == 'yes':
+        loader = BulkLoader()
+        loader.load(filename)
+        loader.close()
+    else:
+        print('\nuse es_load.py to bulk load estack data to elasticSearch')
+        print('either ignore -u if no security features used or append with elasticSearch username and password\n')
+        print(f'python es_load.py -f {filename} -u user:password\n\n')
@@ -0,0 +1,74 @@
+"""
+buffered streaming writer for the estack bulk load output files
+the file is held open for the whole run and the elasticsearch index action
+line is serialized once instead of reopening the file and re-dumping the
+index header for every record
+"""
+# orjson or stdlib json serialization
+from jsoncodec import dumps
+# plain or streaming gzip/zstd output file
+from outputfile import open_output, output_name
+# compact records serialize themselves
+from records import json_text
+
+
+class EstackWriter:
+
+    '''
+    ndjson writer: index action line then the record for each document
+    '''
+
+    def __init__(self, filename, index_tag, mode='w', compression=None):
+
+        '''
+        :param filename: estack output file name; .gz or .zst is added for compressed output
+        :param index_tag: elasticsearch index action dict from elk_index()
+        :param mode: 'w' to start a new file or 'a' to append
+        :param compression: none, gzip, or zstd; defaults to conf.out_compression
+        '''
+
+        self.filename = output_name(filename, compression)
+        self.path = self.filename
+        self.action_line = dumps(index_tag) + "\n"
+        self.file = open_output(self.filename, mode, compression)
+        self.records = 0
+
+    def write(self, record):
+
+        self.write_json(json_text(record))
+
+    def write_json(self, record_text):
+
+        '''
+        :param record_text: record already serialized as single line json
+        '''
+
+        self.file.write(self.action_line + record_text + "\n")
+        self.records += 1
+
+    def flush(self):
+
+        self.file.flush()
+
+    def offset(self):
+
+        '''
+        :return: byte offset of the end of the flushed output
+        '''
+
+        self.flush()
+
+        return self.file.tell()
+
+    def close(self):
+
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
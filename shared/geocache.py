@@ -0,0 +1,170 @@
+"""
+in-memory country code to latitude, longitude cache for session geo enrichment
+data/geoData.csv is read once per process; new geocodes are appended in
+batches and one GoogleV3 client is reused for all lookups
+with conf.geo_offline 'yes' the bundled country centroids are used and Google
+is only queried for codes not in the table
+"""
+import os
+import csv
+import atexit
+import threading
+from datetime import datetime
+
+try:
+    from geopy.geocoders import GoogleV3
+    from geopy.exc import GeocoderServiceError, GeocoderQueryError, GeocoderQuotaExceeded
+except ImportError:
+    GoogleV3 = None
+
+import conf
+from countrydata import country_centroids
+
+geo_cache = None
+geo_cache_lock = threading.Lock()
+
+
+class GeoCache:
+
+    '''
+    country code to (latitude, longitude) with write-behind persistence
+    '''
+
+    def __init__(self, filename='data/geoData.csv', batch_size=None, offline=None):
+
+        if batch_size is None:
+            batch_size = getattr(conf, 'geo_write_batch', 20)
+        if offline is None:
+            offline = getattr(conf, 'geo_offline', 'yes') == 'yes'
+
+        self.filename = filename
+        self.batch_size = batch_size
+        self.locations = {}
+        self.pending = []
+        self.geolocator = None
+        self.geo_key = None
+        self.lock = threading.Lock()
+
+        # check if file exists and if not create it
+        if not os.path.isfile(filename):
+            with open(filename, 'w') as geo_file:
+                geo_writer = csv.writer(geo_file, delimiter=',')
+                geo_writer.writerow(['country_code', 'latitude', 'longitude'])
+
+        with open(filename, 'r') as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)
+            for row in csv_reader:
+                if len(row) == 3 and row[0] not in self.locations:
+                    self.locations[row[0]] = (float(row[1]), float(row[2]))
+
+        # bundled centroids take precedence so known countries need no network lookup
+        if offline:
+            self.locations.update(country_centroids)
+
+        # pending geocodes are written if the run exits early
+        atexit.register(self.flush)
+
+    def get(self, country_code, geo_key):
+
+        '''
+        :param country_code: two letter country code
+        :param geo_key: api key used by Google mapping
+        :return: latitude, longitude; 0, 0 if the country could not be geocoded
+        '''
+
+        location = self.locations.get(country_code)
+        if location is not None:
+            return location
+
+        with self.lock:
+            location = self.locations.get(country_code)
+            if location is None:
+                location = self.geocode(country_code, geo_key)
+
+        return location
+
+    def geocode(self, country_code, geo_key):
+
+        if GoogleV3 is None or not geo_key:
+            print(f'  ***** no geocode for country {country_code} - writing to geocoding-error.csv *****')
+            print('  Failed with message: not in the bundled country data and no -g key or geopy for a lookup')
+            geo_error(country_code, 0, 0)
+            self.locations[country_code] = (0, 0)
+            return 0, 0
+
+        # one client reused for every lookup with the same key
+        if self.geolocator is None or self.geo_key != geo_key:
+            self.geolocator = GoogleV3(api_key=geo_key)
+            self.geo_key = geo_key
+
+        try:
+            location = self.geolocator.geocode(components={'country': country_code}, exactly_one=True)
+
+            try:
+                self.add(country_code, location.latitude, location.longitude)
+                return location.latitude, location.longitude
+
+            except AttributeError:
+                print('  ***** geocode lon-lat error - writing to geocoding-error.csv *****')
+                print(f'  Failed with message: no lon or lat for country {country_code}')
+                geo_error(country_code, 0, 0)
+
+                # stored in the good file to avoid recurring geo lookups
+                self.add(country_code, 0, 0)
+                return 0, 0
+
+        except (GeocoderServiceError, GeocoderQueryError, GeocoderQuotaExceeded) as error_message:
+            print('  ***** geocode lookup error - writing to geocoding-error.csv *****')
+            print('  Failed with message: {0}'.format(error_message))
+            geo_error(country_code, 1, 1)
+
+            # not written to the file so a later run tries again; not retried in this run
+            self.locations[country_code] = (0, 0)
+
+        return 0, 0
+
+    def add(self, country_code, latitude, longitude):
+
+        self.locations[country_code] = (latitude, longitude)
+        self.pending.append([country_code, latitude, longitude])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        '''
+        append geocodes not yet written to the csv file
+        '''
+
+        if not self.pending:
+            return
+
+        with open(self.filename, 'a') as geo_file:
+            geo_writer = csv.writer(geo_file, delimiter=',')
+            geo_writer.writerows(self.pending)
+        self.pending = []
+
+
+def geo_error(country_code, latitude, longitude):
+
+    # append to the error file to see quick view of bad countries
+    with open('geocoding-error.csv', 'a') as uhoh:
+        geo_writer = csv.writer(uhoh, delimiter=',')
+        geo_writer.writerow([datetime.now(), country_code, latitude, longitude])
+
+
+def get_geo_cache():
+
+    '''
+    return the process-wide geo cache, loading data/geoData.csv on first use
+    :return: GeoCache
+    '''
+
+    global geo_cache
+
+    with geo_cache_lock:
+        if geo_cache is None:
+            geo_cache = GeoCache()
+
+    return geo_cache
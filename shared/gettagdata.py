@@ -4,114 +4,163 @@ hash_data reads a list of md5 hash strings and performs 2 Autofocus api
 queries to get verdict/filetype and then signature coverage data
 This provides contextual information in test environments beyond just a hash miss
 """
+import os
 import sys
-import json
+import math
 import argparse
 import requests
+from concurrent.futures import ThreadPoolExecutor
 
 import conf
+from afclient import get_client, retry_wait, quota_exit
+# raised by AFClient.post at the daily quota reserve
+from ratelimit import DailyQuotaExhausted
+from tagindex import reset_tag_index
+from jsoncodec import loads, load, dumps_pretty
 
-def get_tag_count(api_key):
+# tag data query is limited to 200 tags per page
+page_size = 200
 
-    print('=' * 80)
-    print('get total number of tags in Autofocus')
-    print('tag data query is limited to 200 tags; each page query gets a block of 200 tags\n')
+
+def tag_page(page, api_key):
+
+    """
+    get one page of tag data
+    :param page: page number starting at 0
+    :param api_key: Autofocus API key
+    :return: tags response dict including total_count
+    """
 
     # dummy query to make the search work - not limited to Ransomware
     query = {"field":"tag_group","operator":"is","value":"Ransomware"}
 
-    search_values = {"apiKey": api_key,
-                        "query": query,
-                        "pageSize": 200,
-                        "pageNum": 1,
-                        "scope": "visible",
+    search_values = {"query": query,
+                     "pageSize": page_size,
+                     "pageNum": page,
+                     "scope": "visible",
                     }
 
-    headers = {"Content-Type": "application/json"}
-    search_url = f'https://{conf.hostname}/api/v1.0/tags'
+    good_search = False
+    attempt = 0
 
-    try:
-        search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-        search.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print(search)
-        print(search.text)
-        print('\nCorrect errors and rerun the application\n')
-        sys.exit()
-
-    search_dict = json.loads(search.text)
-    total = search_dict['total_count']
-    print(f'found {total} tags')
+    while good_search is False:
+        try:
+            search = get_client(api_key).post('tags', search_values)
+            search.raise_for_status()
+            good_search = True
+        except requests.exceptions.HTTPError:
+            print(search)
+            print(search.text)
+            print('\nCorrect errors and rerun the application\n')
+            sys.exit()
+        except requests.exceptions.ConnectionError:
+            retry_wait(attempt, f'lost connection getting tag page {page}')
+            attempt += 1
+        except requests.exceptions.Timeout:
+            retry_wait(attempt, f'timed out getting tag page {page}')
+            attempt += 1
 
-    return(search_dict['total_count'])
+    return loads(search.content)
 
 
-def tag_query(api_key):
+def load_tag_store(filename='data/tagdata.json'):
 
     """
-    tag query into autofocus to get a complete tag list
-    :param total: max number of tag items expected; should be >> current size
+    read the existing local tag data for an incremental refresh
+    :return: public tag name to tag dict; empty if no local tag data
     """
-    # get total number of tags
-    total = get_tag_count(api_key)
-
-    # set the number of iterations based on total tags and limit of 200 tags per response
-    AFpages = int(round(total/200))
-    tag_dict = {}
-    tag_dict['_tags'] = {}
-    tag_groups = []
-    tags_no_group = []
 
-    print('=' * 80)
-    print('Updating local tag data from Autofocus tag and tag group lists...\n')
+    if os.path.isfile(filename) is False:
+        return {}
 
+    with open(filename, 'r') as tag_file:
+        return load(tag_file)['_tags']
 
-    for page in range(0, AFpages+1, 1):
 
-        # dummy query to make the search work - not limited to Ransomware
-        query = {"field":"tag_group","operator":"is","value":"Ransomware"}
+def tag_query(api_key):
 
-        search_values = {"apiKey": api_key,
-                         "query": query,
-                         "pageSize": 200,
-                         "pageNum": page,
-                         "scope": "visible",
-                        }
+    """
+    tag query into autofocus to get a complete tag list
+    the first page gives total_count then the remaining pages are fetched concurrently
+    and merged into the existing local tag data
+    :param api_key: Autofocus API key
+    """
 
-        headers = {"Content-Type": "application/json"}
-        search_url = f'https://{conf.hostname}/api/v1.0/tags'
+    print('=' * 80)
+    print('Updating local tag data from Autofocus tag and tag group lists...\n')
 
+    try:
+        first_page = tag_page(0, api_key)
+    except DailyQuotaExhausted as quota_message:
+        quota_exit(quota_message)
+    total = first_page['total_count']
+
+    # pages are numbered from 0; ceil so a partial last page is not dropped
+    AFpages = math.ceil(total / page_size)
+    print(f'found {total} tags in {AFpages} pages of {page_size}')
+
+    pages = {0: first_page['tags']}
+    concurrency = max(getattr(conf, 'tag_concurrency', 4), 1)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {page: executor.submit(tag_page, page, api_key) for page in range(1, AFpages)}
         try:
-            search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-            print(f'Getting tag data at page {page} of {AFpages}')
-            search.raise_for_status()
-        except requests.exceptions.HTTPError:
-            print(search)
-            print(search.text)
-            print('\nCorrect errors and rerun the application\n')
-            sys.exit()
+            for page, future in futures.items():
+                pages[page] = future.result()['tags']
+                print(f'Getting tag data at page {page} of {AFpages - 1}')
+        except DailyQuotaExhausted as quota_message:
+            # local tag data is left as it was
+            executor.shutdown(cancel_futures=True)
+            quota_exit(quota_message)
+
+    # tags kept in page order so the local files are stable between runs
+    new_tags = {}
+    for page in range(len(pages)):
+        for tag in pages[page]:
+            new_tags[tag['public_tag_name']] = tag
+
+    old_tags = load_tag_store()
+    added = [tagname for tagname in new_tags if tagname not in old_tags]
+    changed = [tagname for tagname in new_tags if tagname in old_tags and old_tags[tagname] != new_tags[tagname]]
+    removed = [tagname for tagname in old_tags if tagname not in new_tags]
+
+    # a short download only adds and updates; tags are removed after a complete download
+    if len(new_tags) < total:
+        print(f'\nonly {len(new_tags)} of {total} tags returned; keeping local tags not in this download')
+        for tagname in removed:
+            new_tags[tagname] = old_tags[tagname]
+        removed = []
+
+    print(f'\ntag changes: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+
+    if not (added or changed or removed) and os.path.isfile('data/groupList.txt') \
+            and os.path.isfile('data/noGroupTags.txt'):
+        print('local tag data is current')
+        return
 
-        search_dict = json.loads(search.text)
-
-        for tag in search_dict['tags']:
-            tagname = tag['public_tag_name']
-            tag_dict['_tags'][tagname] = tag
+    tag_dict = {}
+    tag_dict['_tags'] = new_tags
+    tag_groups = []
+    tags_no_group = []
 
-            # generate a list of tag group names
-            if 'tag_groups' in tag:
-                for group in tag['tag_groups']:
-                    if group['tag_group_name'] not in tag_groups:
-                        tag_groups.append(group['tag_group_name'])
+    for tagname, tag in new_tags.items():
+        # generate a list of tag group names
+        if 'tag_groups' in tag:
+            for group in tag['tag_groups']:
+                if group['tag_group_name'] not in tag_groups:
+                    tag_groups.append(group['tag_group_name'])
 
-            # or if no group generate a list of tags without groups
-            else:
-                tags_no_group.append(tagname)
+        # or if no group generate a list of tags without groups
+        else:
+            tags_no_group.append(tagname)
 
     with open('data/tagdata.json', 'w') as file:
-        file.write(json.dumps(tag_dict, indent=2, sort_keys=False) + "\n")
+        file.write(dumps_pretty(tag_dict, 2) + "\n")
 
     print('\ntag data refresh complete and stored in tagdata.json')
 
+    # next tag lookup loads the refreshed data
+    reset_tag_index()
+
     with open('data/groupList.txt', 'w') as file:
         for group in tag_groups:
             file.write(f'{group}\n')
@@ -0,0 +1,117 @@
+"""
+json serialization backend for the output writers and readers
+uses orjson when it is installed and falls back to the stdlib json module;
+conf.json_backend selects auto, orjson, or json. Documents hold the same data
+with either backend: orjson single line output has no spaces after separators,
+writes non-ascii text as utf-8 instead of \\u escapes, and writes float
+exponents as 1e-7 instead of 1e-07. Indented output matches the stdlib layout
+"""
+import re
+import sys
+import json
+
+import conf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backends = ['auto', 'orjson', 'json']
+
+# resolved backend name, set on first use
+backend = None
+
+# indentation at the start of each line of orjson two space output
+leading_space_regex = re.compile(r'^( +)', re.MULTILINE)
+
+
+def get_backend():
+
+    '''
+    :return: orjson or json from conf.json_backend; auto picks orjson when installed
+    '''
+
+    global backend
+
+    if backend is None:
+        name = getattr(conf, 'json_backend', 'auto')
+
+        if name not in backends:
+            print(f'\njson_backend {name} is not supported; use auto, orjson, or json')
+            print('correct in conf.py and try again')
+            sys.exit(1)
+
+        if name == 'orjson' and orjson is None:
+            print('\njson_backend orjson requires the orjson package: pip install orjson')
+            print('or set json_backend to auto or json in conf.py')
+            sys.exit(1)
+
+        if name == 'auto':
+            name = 'json' if orjson is None else 'orjson'
+        backend = name
+
+    return backend
+
+
+def dumps(data):
+
+    '''
+    :param data: dict or list to serialize
+    :return: single line json text
+    '''
+
+    if get_backend() == 'orjson':
+        try:
+            return orjson.dumps(data).decode('utf-8')
+        except TypeError:
+            # values orjson does not take such as ints over 64 bits
+            pass
+
+    return json.dumps(data, indent=None, sort_keys=False)
+
+
+def dumps_pretty(data, indent=2):
+
+    '''
+    :param data: dict or list to serialize
+    :param indent: spaces per nesting level
+    :return: indented json text in the same layout as json.dumps(data, indent=indent)
+    '''
+
+    if get_backend() == 'orjson' and indent % 2 == 0:
+        try:
+            text = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode('utf-8')
+        except TypeError:
+            text = None
+        if text is not None:
+            # json strings cannot hold a raw newline so only indentation is widened
+            if indent != 2:
+                scale = indent // 2
+                text = leading_space_regex.sub(lambda match: match.group(1) * scale, text)
+            return text
+
+    return json.dumps(data, indent=indent, sort_keys=False)
+
+
+def loads(text):
+
+    '''
+    :param text: json str or bytes
+    :return: decoded document
+    '''
+
+    if get_backend() == 'orjson':
+        return orjson.loads(text)
+
+    return json.loads(text)
+
+
+def load(json_file):
+
+    '''
+    :param json_file: open json file
+    :return: decoded document
+    '''
+
+    return loads(json_file.read())
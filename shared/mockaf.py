@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+local stand-in Autofocus api server for offline end-to-end runs and benchmarks
+serves the search, results, sig coverage analysis, and tags endpoints used by
+the af_query scripts with synthetic hits, progressive af_complete_percentage,
+bucket_info quotas, and configurable latency and error rate
+point conf.hostname at it, for example hostname = 'http://localhost:8080'
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from filetypedata import filetypetags
+from countrydata import country_centroids
+
+tag_classes = ['malware_family', 'campaign', 'actor', 'exploit', 'malicious_behavior']
+tag_group_names = ['Ransomware', 'BankingTrojan', 'InfoStealer', 'Downloader', 'RemoteAccessTrojan',
+                   'CoinMiner', 'Backdoor', 'Worm', 'Rootkit', 'Spyware']
+industries = ['Finance', 'Government', 'Healthcare', 'Manufacturing', 'Education', 'Retail', 'Utilities']
+regions = ['us', 'emea', 'apac', 'latam']
+apps = ['web-browsing', 'ssl', 'smtp', 'ftp', 'smb', 'dns']
+filetypes = sorted(filetypetags)
+country_codes = sorted(country_centroids)
+
+
+def synthetic_tag(n):
+
+    '''
+    :param n: tag number
+    :return: tag dict in the tags endpoint format
+    '''
+
+    tag = {'public_tag_name': f'Unit42.SynthTag{n}',
+           'tag_name': f'SynthTag{n}',
+           'tag_class': tag_classes[n % len(tag_classes)],
+           'tag_definition_scope': 'public',
+           }
+
+    # about a third of tags have no group
+    if n % 3 != 0:
+        tag['tag_groups'] = [{'tag_group_name': tag_group_names[n % len(tag_group_names)]}]
+
+    return tag
+
+
+def synthetic_hit_tags(rng, tag_count):
+
+    # a few exploit CVE tags so the exploit enrichment path is exercised
+    tags = [f'Unit42.SynthTag{rng.randrange(tag_count)}' for _ in range(rng.randint(0, 4))]
+    if rng.random() < 0.1:
+        tags.append(f'Unit42.CVE-2017-{rng.randint(0, 11999)}')
+
+    return tags
+
+
+def synthetic_sample_hit(key, tag_count=3000, hashtype=None, hashvalue=None):
+
+    '''
+    one samples results hit; the same key always gives the same hit
+    :param key: seed string for the hit
+    :param tag_count: number of synthetic tags to draw from
+    :param hashtype: md5, sha1, or sha256 field set to hashvalue for hash searches
+    :param hashvalue: searched hash value
+    :return: hit dict with _id and _source
+    '''
+
+    rng = random.Random(key)
+    source = {'sha256': hashlib.sha256(key.encode()).hexdigest(),
+              'md5': hashlib.md5(key.encode()).hexdigest(),
+              'sha1': hashlib.sha1(key.encode()).hexdigest(),
+              'create_date': f'2019-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T'
+                             f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}',
+              'malware': rng.choice([0, 1, 1, 1, 2, 3]),
+              }
+
+    if hashtype is not None:
+        source[hashtype] = hashvalue
+
+    if rng.random() < 0.95:
+        source['filetype'] = rng.choice(filetypes)
+
+    tags = synthetic_hit_tags(rng, tag_count)
+    if tags:
+        source['tag'] = tags
+
+    return {'_id': source['sha256'], '_source': source}
+
+
+def synthetic_session_hit(key, tag_count=3000, hashtype=None, hashvalue=None):
+
+    '''
+    one sessions results hit; the same key always gives the same hit
+    :return: hit dict with _id and _source
+    '''
+
+    rng = random.Random(key)
+    sample = synthetic_sample_hit(key, tag_count, hashtype, hashvalue)['_source']
+    dst = rng.choice(country_codes)
+    src = rng.choice(country_codes)
+
+    source = {'sha256': sample['sha256'],
+              'tstamp': sample['create_date'],
+              'device_industry': rng.choice(industries),
+              'region': rng.choice(regions),
+              'dst_countrycode': dst,
+              'dst_country': dst,
+              'dst_port': rng.choice([25, 80, 443, 445, 8080]),
+              'src_countrycode': src,
+              'src_country': src,
+              'src_port': rng.randint(1024, 65535),
+              'upload_src': rng.choice(['Firewall', 'Manual API']),
+              'app': rng.choice(apps),
+              'status': 'complete',
+              }
+
+    if 'tag' in sample:
+        source['tag'] = sample['tag']
+
+    return {'_id': hashlib.md5(f'session-{key}'.encode()).hexdigest(), '_source': source}
+
+
+def synthetic_coverage(sha256hash):
+
+    '''
+    sig coverage analysis response sections for a sample
+    :return: coverage dict with dns_sig, wf_av_sig, fileurl_sig lists
+    '''
+
+    rng = random.Random(sha256hash)
+    coverage = {}
+    for stype in ['dns_sig', 'wf_av_sig', 'fileurl_sig']:
+        coverage[stype] = [{'name': f'{stype}-{rng.randint(1, 99999)}',
+                            'status': rng.random() < 0.7,
+                            'create_date': '2019-06-01 00:00:00'}
+                           for _ in range(rng.randint(0, 2))]
+
+    return coverage
+
+
+class MockState:
+
+    '''
+    searches by cookie and the minute and daily point buckets
+    '''
+
+    def __init__(self, args):
+
+        self.args = args
+        self.searches = {}
+        self.lock = threading.Lock()
+        self.minute_points = args.minute_points
+        self.daily_points = args.daily_points
+        self.minute_reset = time.monotonic() + 60
+        self.requests = 0
+
+    def spend(self, points=1):
+
+        '''
+        :return: True if the points were available
+        '''
+
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if now >= self.minute_reset:
+                self.minute_points = self.args.minute_points
+                self.minute_reset = now + 60
+            if self.minute_points < points or self.daily_points < points:
+                return False
+            self.minute_points -= points
+            self.daily_points -= points
+
+        return True
+
+    def bucket_info(self):
+
+        return {'minute_points': self.args.minute_points,
+                'daily_points': self.args.daily_points,
+                'minute_points_remaining': self.minute_points,
+                'daily_points_remaining': self.daily_points,
+                'minute_bucket_start': '',
+                'daily_bucket_start': '',
+                }
+
+    def new_search(self, kind, values):
+
+        '''
+        register a search and work out the hits it will return
+        :param kind: samples or sessions
+        :param values: search request body
+        :return: cookie
+        '''
+
+        query = values.get('query', {})
+        search = {'kind': kind,
+                  'scan': values.get('type') == 'scan',
+                  'size': values.get('size', 50),
+                  'start': time.monotonic(),
+                  'sent': 0,
+                  'hashtype': None,
+                  'hashes': None,
+                  }
+
+        # hash list searches return a hit for most listed hashes
+        for child in query.get('children', []):
+            field = child.get('field', '')
+            if child.get('operator') == 'is in the list' and field.split('.')[-1] in ('md5', 'sha1', 'sha256'):
+                search['hashtype'] = field.split('.')[-1]
+                search['hashes'] = [value for value in child['value']
+                                    if random.Random(value).random() >= self.args.miss_rate]
+
+        if search['hashes'] is not None:
+            search['total'] = len(search['hashes'])
+        elif search['scan']:
+            search['total'] = self.args.hits
+        else:
+            # count searches get a stable total per query
+            digest = hashlib.md5(json.dumps(query, sort_keys=True).encode()).hexdigest()
+            search['total'] = int(digest[:8], 16) % (self.args.hits + 1)
+
+        cookie = str(uuid.uuid4())
+        with self.lock:
+            self.searches[cookie] = search
+
+        return cookie
+
+    def hit(self, search, n):
+
+        maker = synthetic_sample_hit if search['kind'] == 'samples' else synthetic_session_hit
+        if search['hashes'] is not None:
+            value = search['hashes'][n]
+            return maker(value, self.args.tags, search['hashtype'], value)
+
+        return maker(f'{search["kind"]}-{n}', self.args.tags)
+
+    def results(self, cookie):
+
+        '''
+        :return: results response dict or None for an unknown cookie
+        '''
+
+        with self.lock:
+            search = self.searches.get(cookie)
+            if search is None:
+                return None
+
+            elapsed = time.monotonic() - search['start']
+            if elapsed < self.args.queue_seconds:
+                return {'af_in_progress': True, 'af_cookie': cookie, 'hits': []}
+
+            duration = max(self.args.search_seconds, 0.001)
+            percent = min(100, int((elapsed - self.args.queue_seconds) / duration * 100))
+            available = search['total'] * percent // 100
+
+            if search['scan']:
+                # each poll returns the next page of hits found so far
+                start = search['sent']
+                end = min(start + min(search['size'], 1000), available)
+                search['sent'] = end
+                page = range(start, end)
+                in_progress = percent < 100 or search['sent'] < search['total']
+                total = available
+            else:
+                page = range(0, min(search['size'], available))
+                in_progress = percent < 100
+                total = available
+
+        return {'af_cookie': cookie,
+                'af_complete_percentage': percent,
+                'af_in_progress': in_progress,
+                'total': total,
+                'hits': [self.hit(search, n) for n in page],
+                }
+
+    def tags(self, values):
+
+        page = values.get('pageNum', 0)
+        size = values.get('pageSize', 200)
+        start = page * size
+        end = min(start + size, self.args.tags)
+
+        return {'total_count': self.args.tags,
+                'tags': [synthetic_tag(n) for n in range(start, end)],
+                }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    state = None
+
+    def log_message(self, format, *args):
+
+        if self.state.args.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, status, body):
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+
+        args = self.state.args
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            values = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400, {'message': 'Invalid json body'})
+            return
+
+        if args.latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * args.latency)
+
+        if random.random() < args.error_rate:
+            self.send_json(args.error_status, {'message': 'Synthetic error from the mock server'})
+            return
+
+        if 'apiKey' not in values:
+            self.send_json(401, {'message': 'Missing apiKey'})
+            return
+
+        if not self.state.spend():
+            self.send_json(409, {'message': 'Minute Bucket Exceeded', 'bucket_info': self.state.bucket_info()})
+            return
+
+        parts = self.path.strip('/').split('/')
+        if parts[:2] != ['api', 'v1.0']:
+            self.send_json(404, {'message': 'Not found'})
+            return
+        parts = parts[2:]
+
+        if parts in (['samples', 'search'], ['sessions', 'search']):
+            body = {'af_cookie': self.state.new_search(parts[0], values)}
+        elif len(parts) == 3 and parts[0] in ('samples', 'sessions') and parts[1] == 'results':
+            body = self.state.results(parts[2])
+            if body is None:
+                self.send_json(404, {'message': 'Unknown cookie'})
+                return
+        elif len(parts) == 3 and parts[0] == 'sample' and parts[2] == 'analysis':
+            body = {'coverage': synthetic_coverage(parts[1])}
+        elif parts == ['tags']:
+            body = self.state.tags(values)
+        else:
+            self.send_json(404, {'message': 'Not found'})
+            return
+
+        body['bucket_info'] = self.state.bucket_info()
+        self.send_json(200, body)
+
+
+def start_server(args):
+
+    '''
+    start the mock server on a background thread
+    :param args: parsed mock server options
+    :return: ThreadingHTTPServer; call shutdown() to stop
+    '''
+
+    handler = type('BoundMockHandler', (MockHandler,), {'state': MockState(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(description='local stand-in Autofocus api server')
+    parser.add_argument("--host", help="listen address", type=str, default='127.0.0.1')
+    parser.add_argument("-p", "--port", help="listen port", type=int, default=8080)
+    parser.add_argument("--hits", help="hits for non-hash scan searches and max count search total",
+                        type=int, default=5000)
+    parser.add_argument("--tags", help="number of synthetic tags", type=int, default=3000)
+    parser.add_argument("--miss_rate", help="fraction of listed hashes not found", type=float, default=0.05)
+    parser.add_argument("--queue_seconds", help="seconds before a search starts returning results",
+                        type=float, default=1.0)
+    parser.add_argument("--search_seconds", help="seconds for a search to reach 100 percent",
+                        type=float, default=5.0)
+    parser.add_argument("--latency", help="mean added response latency in seconds", type=float, default=0.0)
+    parser.add_argument("--error_rate", help="fraction of requests answered with error_status",
+                        type=float, default=0.0)
+    parser.add_argument("--error_status", help="http status for synthetic errors", type=int, default=500)
+    parser.add_argument("--minute_points", help="minute bucket size", type=int, default=5000)
+    parser.add_argument("--daily_points", help="daily bucket size", type=int, default=1000000)
+    parser.add_argument("-v", "--verbose", help="log each request", action="store_true")
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = get_parser().parse_args()
+    server = start_server(args)
+    print(f'mock Autofocus api listening on http://{args.host}:{args.port}')
+    print(f"set hostname = 'http://{args.host}:{args.port}' in conf.py to use it; Ctrl-C to stop")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
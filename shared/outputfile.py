@@ -0,0 +1,174 @@
+"""
+streaming gzip or zstd compression for the estack and pretty output files
+conf.out_compression selects none, gzip, or zstd; zstd needs the optional
+zstandard package. Each flush ends the current gzip member or zstd frame so
+the file is always a complete concatenated stream up to the last flush and
+a checkpoint can truncate to that point and append
+"""
+import io
+import os
+import sys
+import gzip
+import zlib
+
+import conf
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# write buffer size in bytes
+buffer_size = 1024 * 1024
+
+suffixes = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def get_compression(compression=None):
+
+    '''
+    :param compression: none, gzip, or zstd; defaults to conf.out_compression
+    :return: validated compression name
+    '''
+
+    if compression is None:
+        compression = getattr(conf, 'out_compression', 'none')
+
+    if compression not in suffixes:
+        print(f'\nout_compression {compression} is not supported; use none, gzip, or zstd')
+        print('correct in conf.py and try again')
+        sys.exit(1)
+
+    if compression == 'zstd' and zstandard is None:
+        print('\nout_compression zstd requires the zstandard package: pip install zstandard')
+        print('or set out_compression to gzip or none in conf.py')
+        sys.exit(1)
+
+    return compression
+
+
+def output_name(filename, compression=None):
+
+    '''
+    :param filename: output file name without a compression suffix
+    :param compression: none, gzip, or zstd; defaults to conf.out_compression
+    :return: file name with .gz or .zst added for compressed output
+    '''
+
+    return filename + suffixes[get_compression(compression)]
+
+
+class CompressedWriter:
+
+    '''
+    text file writer that streams through a gzip or zstd compressor
+    '''
+
+    def __init__(self, filename, mode, compression):
+
+        self.raw = open(filename, f'{mode}b', buffering=buffer_size)
+        self.compression = compression
+        self.compressor = None
+
+    @property
+    def closed(self):
+
+        return self.raw.closed
+
+    def write(self, text):
+
+        # the compressor is started on first write so an empty flush adds nothing
+        if self.compressor is None:
+            if self.compression == 'gzip':
+                self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            else:
+                self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+        self.raw.write(self.compressor.compress(text.encode('utf-8')))
+
+    def flush(self):
+
+        '''
+        end the current gzip member or zstd frame and flush to disk
+        '''
+
+        if self.compressor is not None:
+            self.raw.write(self.compressor.flush())
+            self.compressor = None
+        self.raw.flush()
+
+    def tell(self):
+
+        return self.raw.tell()
+
+    def close(self):
+
+        if not self.raw.closed:
+            self.flush()
+            self.raw.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+def open_output(filename, mode='w', compression=None):
+
+    '''
+    :param filename: output file name including any compression suffix
+    :param mode: 'w' or 'a'
+    :param compression: none, gzip, or zstd; defaults to conf.out_compression
+    :return: writable text file object
+    '''
+
+    compression = get_compression(compression)
+
+    if compression == 'none':
+        return open(filename, mode, buffering=buffer_size, encoding='utf-8')
+
+    return CompressedWriter(filename, mode, compression)
+
+
+def open_input(filename, binary=False):
+
+    '''
+    open a plain, .gz, or .zst output file for streaming reads
+    :param filename: file name; compression is taken from the suffix
+    :param binary: True for a bytes reader
+    :return: readable file object
+    '''
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb') if binary else gzip.open(filename, 'rt', encoding='utf-8')
+
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            print(f'\nreading {filename} requires the zstandard package: pip install zstandard')
+            sys.exit(1)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
+        reader = io.BufferedReader(reader, buffer_size)
+        return reader if binary else io.TextIOWrapper(reader, encoding='utf-8')
+
+    return open(filename, 'rb') if binary else open(filename, 'r', encoding='utf-8')
+
+
+def find_output(filename):
+
+    '''
+    :param filename: output file name without a compression suffix
+    :return: name of the existing plain or compressed file, configured compression first
+    '''
+
+    configured = output_name(filename)
+    if os.path.isfile(configured):
+        return configured
+
+    for suffix in suffixes.values():
+        if os.path.isfile(filename + suffix):
+            return filename + suffix
+
+    return configured
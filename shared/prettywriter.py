@@ -0,0 +1,197 @@
+"""
+append-only writer for the readable 'pretty' json output files
+records are appended to a json lines intermediate file as pages are parsed
+and the pretty file is built from it in a single pass at the end of the run
+so each page costs only its own records instead of a full rewrite
+"""
+import os
+import re
+import json
+
+# orjson or stdlib json serialization
+from jsoncodec import loads, dumps_pretty
+# plain or streaming gzip/zstd output file
+from outputfile import open_output, output_name, open_input
+# compact records serialize themselves
+from records import json_text
+
+# write buffer size in bytes
+buffer_size = 1024 * 1024
+
+# whitespace and commas between records in the pretty list
+separator_regex = re.compile(r'[\s,]*')
+
+
+def read_json_lines(filename):
+
+    '''
+    stream records from a json lines file
+    :param filename: json lines file name
+    :return: generator of record dicts
+    '''
+
+    with open(filename, 'r', encoding='utf-8') as lines_file:
+        for line in lines_file:
+            if line.strip():
+                yield loads(line)
+
+
+def read_pretty_records(filename, chunk_size=buffer_size):
+
+    '''
+    stream records from a pretty json file of the form {key: [records]}
+    the file is decoded a chunk at a time so only one record is held as a dict
+    :param filename: plain, .gz, or .zst pretty json file name
+    :param chunk_size: characters read per chunk
+    :return: generator of record dicts
+    '''
+
+    decode = json.JSONDecoder().raw_decode
+    skip = separator_regex.match
+
+    with open_input(filename) as pretty_file:
+        buffer = ''
+        position = 0
+        in_list = False
+
+        while True:
+            # skip whitespace and separators up to the next record
+            position = skip(buffer, position).end()
+
+            if not in_list:
+                start = buffer.find('[', position)
+                if start != -1:
+                    in_list = True
+                    position = start + 1
+                    continue
+            elif position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    record, end = decode(buffer, position)
+                except ValueError:
+                    # record continues in the next chunk
+                    record = None
+                if record is not None:
+                    position = end
+                    yield record
+                    continue
+
+            chunk = pretty_file.read(chunk_size)
+            if not chunk:
+                if in_list and position < len(buffer):
+                    raise ValueError(f'{filename} ends inside a record')
+                return
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+class PrettyWriter:
+
+    '''
+    builds {key: [records]} pretty json output from a json lines intermediate
+    '''
+
+    def __init__(self, filename, key, indent=2, mode='w', compression=None):
+
+        '''
+        :param filename: pretty output file name; .gz or .zst is added for compressed output
+        :param key: top level list name such as samples or sessions
+        :param indent: json indent for the pretty output
+        :param mode: 'w' to start new or 'a' to keep records already in the intermediate
+        :param compression: none, gzip, or zstd for the pretty output; defaults to conf.out_compression
+        '''
+
+        self.filename = output_name(filename, compression)
+        self.compression = compression
+        # the intermediate stays uncompressed so it can be read back and truncated on resume
+        self.lines_filename = f'{filename}l'
+        self.path = self.lines_filename
+        self.key = key
+        self.indent = indent
+        self.file = open(self.lines_filename, mode, buffering=buffer_size, encoding='utf-8')
+        self.records = 0
+
+    def write(self, record):
+
+        self.write_json(json_text(record))
+
+    def write_json(self, record_text):
+
+        '''
+        :param record_text: record already serialized as single line json
+        '''
+
+        self.file.write(record_text + "\n")
+        self.records += 1
+
+    def flush(self):
+
+        if not self.file.closed:
+            self.file.flush()
+
+    def offset(self):
+
+        '''
+        :return: byte offset of the end of the flushed intermediate
+        '''
+
+        self.flush()
+
+        return self.file.tell()
+
+    def records_written(self):
+
+        '''
+        stream back all records written so far
+        :return: generator of record dicts
+        '''
+
+        self.flush()
+
+        return read_json_lines(self.lines_filename)
+
+    def materialize(self):
+
+        '''
+        write the pretty json file from the intermediate in one pass
+        same layout as json.dumps({key: records}, indent=indent)
+        can be called at any point to get a current pretty file
+        '''
+
+        pad = ' ' * self.indent
+        first = True
+
+        with open_output(self.filename, 'w', self.compression) as pretty_file:
+            pretty_file.write('{\n' + pad + json.dumps(self.key) + ': [')
+            for record in self.records_written():
+                record_text = dumps_pretty(record, self.indent)
+                record_text = record_text.replace('\n', '\n' + pad * 2)
+                if first:
+                    pretty_file.write('\n' + pad * 2 + record_text)
+                    first = False
+                else:
+                    pretty_file.write(',\n' + pad * 2 + record_text)
+            if first:
+                pretty_file.write(']\n}\n')
+            else:
+                pretty_file.write('\n' + pad + ']\n}\n')
+
+    def close(self, materialize=True):
+
+        '''
+        close the intermediate and optionally build the pretty file
+        the intermediate is removed once the pretty file is written
+        no pretty file is created if no records were written
+        :param materialize: False to keep only the json lines intermediate
+        '''
+
+        if self.file.closed:
+            return
+
+        self.file.close()
+
+        if materialize:
+            if self.records > 0:
+                self.materialize()
+            os.remove(self.lines_filename)
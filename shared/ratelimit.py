@@ -0,0 +1,144 @@
+"""
+Autofocus point quota limiter shared by all requests through afclient
+every api response carries bucket_info with minute and daily points remaining
+those values refill a local budget that requests draw from before being sent
+so parallel searches, polls, and sig lookups stay under the minute bucket
+and stop before the daily bucket runs out
+"""
+import re
+import time
+import threading
+
+import conf
+
+# bucket_info values pulled from the raw response text so large results pages
+# are not decoded twice just to read the quota
+minute_regex = re.compile(r'"minute_points_remaining"\s*:\s*(-?\d+)')
+daily_regex = re.compile(r'"daily_points_remaining"\s*:\s*(-?\d+)')
+
+
+class DailyQuotaExhausted(Exception):
+    pass
+
+
+class QuotaLimiter:
+
+    '''
+    points budget for one api key
+    minute budget blocks callers until the bucket refills
+    daily budget raises DailyQuotaExhausted once only the reserve is left
+    '''
+
+    def __init__(self, minute_reserve=None, daily_reserve=None, refill_seconds=60):
+
+        if minute_reserve is None:
+            minute_reserve = getattr(conf, 'minute_points_reserve', 0)
+        if daily_reserve is None:
+            daily_reserve = getattr(conf, 'daily_points_reserve', 0)
+
+        self.minute_reserve = minute_reserve
+        self.daily_reserve = daily_reserve
+        self.refill_seconds = refill_seconds
+
+        # None until the first response reports the bucket values
+        self.minute_remaining = None
+        self.daily_remaining = None
+        self.in_flight = 0
+        self.refill_at = None
+        self.throttled = 0.0
+        # server reported values for the run metrics
+        self.minute_reported = None
+        self.daily_reported = None
+        self.daily_first = None
+        self.condition = threading.Condition()
+
+    def acquire(self, cost=1):
+
+        '''
+        block until the minute budget covers this request then reserve it
+        :param cost: points expected for the request
+        '''
+
+        with self.condition:
+            while True:
+                if self.daily_remaining is not None and self.daily_remaining - cost < self.daily_reserve:
+                    raise DailyQuotaExhausted(f'{self.daily_remaining} daily points remaining '
+                                              f'with {self.daily_reserve} held in reserve')
+
+                if self.minute_remaining is None or self.minute_remaining - cost >= self.minute_reserve:
+                    if self.minute_remaining is not None:
+                        self.minute_remaining -= cost
+                    if self.daily_remaining is not None:
+                        self.daily_remaining -= cost
+                    self.in_flight += 1
+                    return
+
+                # minute bucket drained; wait for the refill then let a request probe the new value
+                now = time.monotonic()
+                if self.refill_at is None:
+                    self.refill_at = now + self.refill_seconds
+                if now >= self.refill_at:
+                    self.minute_remaining = None
+                    self.refill_at = None
+                    continue
+
+                wait = self.refill_at - now
+                self.throttled += wait
+                self.condition.wait(wait)
+
+    def release(self, response_text=None):
+
+        '''
+        finish a request and update the budget from its bucket_info
+        :param response_text: raw api response text or None if the request failed
+        '''
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if response_text:
+                minute = minute_regex.search(response_text)
+                daily = daily_regex.search(response_text)
+
+                # server values do not yet count other requests still in flight
+                if minute:
+                    self.minute_remaining = int(minute.group(1)) - self.in_flight
+                    if self.minute_remaining > self.minute_reserve:
+                        self.refill_at = None
+                if daily:
+                    self.daily_remaining = int(daily.group(1)) - self.in_flight
+
+                if minute:
+                    self.minute_reported = int(minute.group(1))
+                if daily:
+                    reported = int(daily.group(1))
+                    # the first response already includes its own point
+                    if self.daily_first is None:
+                        self.daily_first = reported + 1
+                    # responses can arrive out of order so keep the lowest value seen
+                    if self.daily_reported is None or reported < self.daily_reported:
+                        self.daily_reported = reported
+
+            self.condition.notify_all()
+
+    def points_used(self):
+
+        '''
+        :return: daily points used since the first response, 0 if none reported
+        '''
+
+        with self.condition:
+            if self.daily_first is None:
+                return 0
+            return max(self.daily_first - self.daily_reported, 0)
+
+    def minute_exhausted(self):
+
+        '''
+        server rejected a request for the minute quota so hold off until refill
+        '''
+
+        with self.condition:
+            self.minute_remaining = self.minute_reserve
+            if self.refill_at is None:
+                self.refill_at = time.monotonic() + self.refill_seconds
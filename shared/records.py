@@ -0,0 +1,157 @@
+"""
+compact slotted record types for the sample and session output documents
+fields left as None are not written, so to_json gives the same document as a
+dict with only the set keys, in field order. Tag, class, and group names are
+interned and tag lists are tuples with one shared empty tuple, so the sample
+list held for the sig coverage pass costs far less per record than dicts
+"""
+import sys
+from operator import attrgetter
+
+# orjson or stdlib json serialization
+from jsoncodec import dumps
+
+# shared by every record with an empty tag list; never mutated
+empty = ()
+# shared by every record for the unused tag_array field; never mutated
+empty_map = {}
+
+
+def intern_all(values):
+
+    '''
+    :param values: list of strings or None
+    :return: tuple of interned strings, the shared empty tuple, or None
+    '''
+
+    if values is None:
+        return None
+    if not values:
+        return empty
+
+    return tuple([sys.intern(value) for value in values])
+
+
+def json_text(record):
+
+    '''
+    :param record: CompactRecord or dict
+    :return: single line json document
+    '''
+
+    if isinstance(record, CompactRecord):
+        return record.to_json()
+
+    return dumps(record)
+
+
+class CompactRecord:
+
+    '''
+    base for slotted records; subclasses set fields, interned, and interned_lists
+    keys read back from a file that are not fields are kept in extra
+    '''
+
+    __slots__ = ()
+    fields = ()
+    # string fields interned when loaded from a dict
+    interned = frozenset()
+    # string list fields stored as tuples of interned strings
+    interned_lists = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+
+        super().__init_subclass__(**kwargs)
+        cls.field_set = frozenset(cls.fields)
+        cls.values = attrgetter(*cls.fields)
+        # (field, load step) pairs so from_dict does no per-key set lookups
+        cls.loaders = tuple((name, 'intern' if name in cls.interned else
+                             'list' if name in cls.interned_lists else
+                             'map' if name == 'tag_array' else None) for name in cls.fields)
+
+    def __init__(self, **values):
+
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, document):
+
+        '''
+        :param document: dict read back from an output file
+        :return: record with the same set fields
+        '''
+
+        record = cls.__new__(cls)
+        get = document.get
+
+        for name, step in cls.loaders:
+            value = get(name)
+            if step is not None and value is not None:
+                if step == 'intern' and isinstance(value, str):
+                    value = sys.intern(value)
+                elif step == 'list' and isinstance(value, list):
+                    value = intern_all(value)
+                elif step == 'map' and value == {}:
+                    value = empty_map
+            setattr(record, name, value)
+
+        record.extra = None
+        if not cls.field_set.issuperset(document):
+            record.extra = {name: value for name, value in document.items() if name not in cls.field_set}
+
+        return record
+
+    def to_dict(self):
+
+        document = {name: value for name, value in zip(self.fields, self.values(self)) if value is not None}
+        if self.extra:
+            document.update(self.extra)
+
+        return document
+
+    def to_json(self):
+
+        return dumps(self.to_dict())
+
+
+class SampleRecord(CompactRecord):
+
+    '''
+    threat_data sample document; sig fields are set by the sig coverage pass
+    '''
+
+    fields = ('hashvalue', 'sample_found', 'sha256hash', 'create_date', 'query_tag', 'query_time', 'verdict',
+              'filetype', 'filetype_group', 'all_tags', 'tag_array', 'exploit_data',
+              'priority_tags_public', 'priority_tags_name', 'tag_classes', 'malware_tags', 'campaign_tags',
+              'actor_tags', 'exploit_tags', 'tag_groups',
+              'dns_sig', 'dns_sig_sig_state', 'wf_av_sig', 'wf_av_sig_sig_state',
+              'fileurl_sig', 'fileurl_sig_sig_state', 'sig_state_all')
+    __slots__ = fields + ('extra',)
+
+    interned = frozenset(['query_tag', 'query_time', 'verdict', 'filetype', 'filetype_group',
+                          'dns_sig_sig_state', 'wf_av_sig_sig_state', 'fileurl_sig_sig_state', 'sig_state_all'])
+    interned_lists = frozenset(['all_tags', 'priority_tags_public', 'priority_tags_name', 'tag_classes',
+                                'malware_tags', 'campaign_tags', 'actor_tags', 'exploit_tags', 'tag_groups'])
+
+
+class SessionRecord(CompactRecord):
+
+    '''
+    session_data session document
+    '''
+
+    fields = ('session_id', 'sha256', 'tstamp', 'device_industry', 'region',
+              'dst_countrycode', 'dst_lat', 'dst_lon', 'dst_country', 'dst_port',
+              'src_countrycode', 'src_lat', 'src_lon', 'src_country', 'src_port',
+              'upload_src', 'app', 'status', 'query_tag', 'query_time',
+              'all_tags', 'tag_array', 'priority_tags_public', 'priority_tags_name', 'tag_classes',
+              'malware_tags', 'campaign_tags', 'actor_tags', 'exploit_tags', 'tag_groups')
+    __slots__ = fields + ('extra',)
+
+    interned = frozenset(['device_industry', 'region', 'dst_countrycode', 'dst_country', 'src_countrycode',
+                          'src_country', 'upload_src', 'app', 'status', 'query_tag', 'query_time'])
+    interned_lists = frozenset(['all_tags', 'priority_tags_public', 'priority_tags_name', 'tag_classes',
+                                'malware_tags', 'campaign_tags', 'actor_tags', 'exploit_tags', 'tag_groups'])
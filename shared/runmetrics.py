@@ -0,0 +1,297 @@
+"""
+per-stage timing, counters, and Autofocus quota use for one script run
+stages such as submit, poll_wait, fetch, parse, enrich, geo, write, and
+sig_lookup are kept as fixed-bucket histograms so long runs use constant
+memory; at the end of a run a json report is written to conf.metrics_dir and,
+when conf.metrics_textfile_dir is set, a Prometheus textfile for the
+node_exporter textfile collector
+"""
+import os
+import math
+import time
+import json
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+import conf
+
+# histogram upper bounds in seconds; the last bucket is +Inf
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+
+run_metrics = None
+run_metrics_lock = threading.Lock()
+
+
+class Histogram:
+
+    '''
+    count, sum, max, and per-bucket counts of observed durations
+    '''
+
+    def __init__(self):
+
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+
+        self.counts[bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+
+        '''
+        :return: dict of count, seconds, mean, max, and cumulative bucket counts
+        '''
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(buckets, self.counts):
+            running += count
+            cumulative['+Inf' if bound == math.inf else str(bound)] = running
+
+        return {'count': self.count,
+                'seconds': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else 0,
+                'max': round(self.max, 6),
+                'buckets': cumulative,
+                }
+
+
+class RunMetrics:
+
+    '''
+    stage and http latency histograms, event counters, and quota limiters for the run
+    safe to update from the search, poll, and sig lookup threads
+    '''
+
+    def __init__(self):
+
+        self.start = datetime.now()
+        self.start_perf = time.perf_counter()
+        self.stages = {}
+        self.http = {}
+        self.counters = {}
+        self.limiters = []
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+
+        '''
+        :param stage: stage name such as fetch or parse
+        :param seconds: time spent in one pass of the stage
+        '''
+
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_http(self, endpoint, seconds):
+
+        with self.lock:
+            histogram = self.http.get(endpoint)
+            if histogram is None:
+                histogram = self.http[endpoint] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+
+        '''
+        time the with block as one pass of the stage
+        '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+
+        '''
+        :param name: counter name such as records or pages
+        :param value: amount to add
+        '''
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_limiter(self, limiter):
+
+        '''
+        :param limiter: QuotaLimiter whose points use and quota waits are reported
+        '''
+
+        with self.lock:
+            self.limiters.append(limiter)
+
+    def quota(self):
+
+        '''
+        :return: points used, time held for the minute quota, and last remaining values
+        '''
+
+        quota = {'points_used': 0, 'quota_wait_seconds': 0.0,
+                 'minute_points_remaining': None, 'daily_points_remaining': None}
+
+        for limiter in self.limiters:
+            quota['points_used'] += limiter.points_used()
+            quota['quota_wait_seconds'] += limiter.throttled
+            if limiter.minute_reported is not None:
+                quota['minute_points_remaining'] = limiter.minute_reported
+            if limiter.daily_reported is not None:
+                quota['daily_points_remaining'] = limiter.daily_reported
+
+        quota['quota_wait_seconds'] = round(quota['quota_wait_seconds'], 3)
+
+        return quota
+
+    def report(self, script_name, query_tag):
+
+        '''
+        :param script_name: script file name such as threat_data.py
+        :param query_tag: identifier for this script run
+        :return: run report dict
+        '''
+
+        elapsed = time.perf_counter() - self.start_perf
+
+        with self.lock:
+            stages = {name: histogram.summary() for name, histogram in sorted(self.stages.items())}
+            http = {name: histogram.summary() for name, histogram in sorted(self.http.items())}
+            counters = dict(sorted(self.counters.items()))
+
+        records = counters.get('records', 0)
+        report = {'script': script_name,
+                  'query_tag': query_tag,
+                  'start_time': self.start.isoformat(),
+                  'end_time': datetime.now().isoformat(),
+                  'elapsed_seconds': round(elapsed, 3),
+                  'records': records,
+                  'records_per_sec': round(records / elapsed, 1) if elapsed > 0 else 0,
+                  'stages': stages,
+                  'http': http,
+                  'counters': counters,
+                  'quota': self.quota(),
+                  }
+
+        # parse throughput without the time spent waiting on Autofocus
+        if 'parse' in stages and stages['parse']['seconds'] > 0:
+            report['parse_records_per_sec'] = round(records / stages['parse']['seconds'], 1)
+
+        return report
+
+    def write_report(self, script_name, query_tag):
+
+        '''
+        write the json run report and the optional Prometheus textfile
+        :return: json report file name or None if reports are off
+        '''
+
+        if getattr(conf, 'metrics_report', 'yes') != 'yes':
+            return None
+
+        report = self.report(script_name, query_tag)
+
+        metrics_dir = getattr(conf, 'metrics_dir', 'metrics')
+        os.makedirs(metrics_dir, exist_ok=True)
+        stem = script_name.replace('.py', '')
+        filename = f"{metrics_dir}/{stem}_{query_tag}_{self.start.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(filename, 'w') as report_file:
+            report_file.write(json.dumps(report, indent=2) + "\n")
+        print(f'run metrics written to {filename}')
+
+        textfile_dir = getattr(conf, 'metrics_textfile_dir', '')
+        if textfile_dir:
+            write_textfile(report, f'{textfile_dir}/pan_tort_{stem}.prom')
+
+        return filename
+
+
+def prometheus_histogram(lines, name, labels, summary):
+
+    for bound, count in summary['buckets'].items():
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+    lines.append(f'{name}_sum{{{labels}}} {summary["seconds"]}')
+    lines.append(f'{name}_count{{{labels}}} {summary["count"]}')
+
+
+def write_textfile(report, filename):
+
+    '''
+    write the run report in Prometheus text format
+    written to a temp file and renamed so the collector never reads a partial file
+    :param report: run report dict
+    :param filename: .prom file name in the node_exporter textfile directory
+    '''
+
+    script = f'script="{report["script"].replace(".py", "")}"'
+    quota = report['quota']
+
+    lines = ['# HELP pan_tort_stage_seconds time spent per pass of each run stage',
+             '# TYPE pan_tort_stage_seconds histogram']
+    for stage, summary in report['stages'].items():
+        prometheus_histogram(lines, 'pan_tort_stage_seconds', f'{script},stage="{stage}"', summary)
+
+    lines += ['# HELP pan_tort_http_request_seconds Autofocus request latency by endpoint',
+              '# TYPE pan_tort_http_request_seconds histogram']
+    for endpoint, summary in report['http'].items():
+        prometheus_histogram(lines, 'pan_tort_http_request_seconds', f'{script},endpoint="{endpoint}"', summary)
+
+    lines += ['# HELP pan_tort_events_total run event counts',
+              '# TYPE pan_tort_events_total counter']
+    for name, value in report['counters'].items():
+        lines.append(f'pan_tort_events_total{{{script},event="{name}"}} {value}')
+
+    lines += ['# HELP pan_tort_run_seconds elapsed time of the last run',
+              '# TYPE pan_tort_run_seconds gauge',
+              f'pan_tort_run_seconds{{{script}}} {report["elapsed_seconds"]}',
+              '# HELP pan_tort_records_per_second records written per second of the last run',
+              '# TYPE pan_tort_records_per_second gauge',
+              f'pan_tort_records_per_second{{{script}}} {report["records_per_sec"]}',
+              '# HELP pan_tort_points_used Autofocus points used by the last run',
+              '# TYPE pan_tort_points_used gauge',
+              f'pan_tort_points_used{{{script}}} {quota["points_used"]}',
+              '# HELP pan_tort_quota_wait_seconds time held for the minute quota in the last run',
+              '# TYPE pan_tort_quota_wait_seconds gauge',
+              f'pan_tort_quota_wait_seconds{{{script}}} {quota["quota_wait_seconds"]}',
+              '# HELP pan_tort_last_run_timestamp_seconds end time of the last run',
+              '# TYPE pan_tort_last_run_timestamp_seconds gauge',
+              f'pan_tort_last_run_timestamp_seconds{{{script}}} {time.time():.0f}']
+
+    if quota['daily_points_remaining'] is not None:
+        lines += ['# HELP pan_tort_daily_points_remaining Autofocus daily points left after the last run',
+                  '# TYPE pan_tort_daily_points_remaining gauge',
+                  f'pan_tort_daily_points_remaining{{{script}}} {quota["daily_points_remaining"]}']
+
+    temp_name = f'{filename}.tmp'
+    with open(temp_name, 'w') as prom_file:
+        prom_file.write('\n'.join(lines) + '\n')
+    os.replace(temp_name, filename)
+    print(f'prometheus metrics written to {filename}')
+
+
+def get_metrics():
+
+    '''
+    return the process-wide run metrics, started on first use
+    :return: RunMetrics
+    '''
+
+    global run_metrics
+
+    with run_metrics_lock:
+        if run_metrics is None:
+            run_metrics = RunMetrics()
+
+    return run_metrics
@@ -0,0 +1,98 @@
+"""
+local sqlite cache of sig coverage responses keyed by sha256
+reruns over overlapping sample sets skip the /analysis lookup for samples
+whose coverage was fetched within conf.sig_cache_ttl_days
+"""
+import time
+import sqlite3
+
+import conf
+
+
+class SigCoverageCache:
+
+    '''
+    sha256 to analysis response text with a ttl and a least recently used size cap
+    use from a single thread
+    '''
+
+    def __init__(self, path=None, ttl_days=None, max_entries=None):
+
+        if path is None:
+            path = getattr(conf, 'sig_cache_file', 'data/sig_coverage_cache.db')
+        if ttl_days is None:
+            ttl_days = getattr(conf, 'sig_cache_ttl_days', 7)
+        if max_entries is None:
+            max_entries = getattr(conf, 'sig_cache_max_entries', 500000)
+
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS coverage ('
+                        'sha256 TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                        'fetched REAL NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS coverage_last_used ON coverage (last_used)')
+        self.db.commit()
+
+    def get(self, sha256hash):
+
+        '''
+        cached response for a sample if fetched within the ttl
+        :param sha256hash: sample sha256
+        :return: analysis response text or None if missing or stale
+        '''
+
+        now = time.time()
+        row = self.db.execute('SELECT response, fetched FROM coverage WHERE sha256 = ?',
+                              (sha256hash,)).fetchone()
+
+        if row is None or now - row[1] > self.ttl:
+            self.misses += 1
+            return None
+
+        self.db.execute('UPDATE coverage SET last_used = ? WHERE sha256 = ?', (now, sha256hash))
+        self.hits += 1
+
+        return row[0]
+
+    def put(self, sha256hash, response_text):
+
+        '''
+        store a fresh analysis response for a sample
+        :param sha256hash: sample sha256
+        :param response_text: analysis response text
+        '''
+
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO coverage (sha256, response, fetched, last_used) '
+                        'VALUES (?, ?, ?, ?)', (sha256hash, response_text, now, now))
+        self.stores += 1
+
+        # commit in batches so a large run is not one fsync per sample
+        if self.stores % 500 == 0:
+            self.db.commit()
+
+    def prune(self):
+
+        '''
+        drop stale entries then least recently used entries over the size cap
+        '''
+
+        self.db.execute('DELETE FROM coverage WHERE fetched < ?', (time.time() - self.ttl,))
+        self.db.execute('DELETE FROM coverage WHERE sha256 IN ('
+                        'SELECT sha256 FROM coverage ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                        (self.max_entries,))
+        self.db.commit()
+
+    def close(self):
+
+        self.prune()
+        self.db.close()
+
+    def print_stats(self):
+
+        print(f'sig coverage cache: {self.hits} hits, {self.misses} misses')
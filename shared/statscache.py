@@ -0,0 +1,74 @@
+"""
+local sqlite store of tag group monthly sample counts
+counts for months that have ended are marked final and reused by later
+runs so only missing or refreshed months are queried again
+"""
+import time
+import sqlite3
+
+import conf
+
+
+class StatsCountCache:
+
+    '''
+    (tag_group, month, verdict) to sample count with a final flag for closed months
+    use from a single thread
+    '''
+
+    def __init__(self, path=None):
+
+        if path is None:
+            path = getattr(conf, 'stats_cache_file', 'data/tag_group_stats_cache.db')
+
+        self.hits = 0
+        self.stores = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS counts ('
+                        'tag_group TEXT NOT NULL, month TEXT NOT NULL, verdict TEXT NOT NULL, '
+                        'total INTEGER NOT NULL, final INTEGER NOT NULL, fetched REAL NOT NULL, '
+                        'PRIMARY KEY (tag_group, month, verdict))')
+        self.db.commit()
+
+    def get(self, tag_group, month, verdict):
+
+        '''
+        final count for a closed month
+        :param tag_group: tag group name
+        :param month: month as YYYY-MM
+        :param verdict: verdict used in the count search
+        :return: sample count or None if not stored or not final
+        '''
+
+        row = self.db.execute('SELECT total FROM counts WHERE tag_group = ? AND month = ? AND verdict = ? '
+                              'AND final = 1', (tag_group, month, verdict)).fetchone()
+
+        if row is None:
+            return None
+
+        self.hits += 1
+
+        return row[0]
+
+    def put(self, tag_group, month, verdict, total, final):
+
+        '''
+        store a count from Autofocus
+        :param final: True if the month has ended
+        '''
+
+        self.db.execute('INSERT OR REPLACE INTO counts (tag_group, month, verdict, total, final, fetched) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', (tag_group, month, verdict, total, int(final), time.time()))
+        self.stores += 1
+
+        # committed per count so an interrupted run keeps what it fetched
+        self.db.commit()
+
+    def close(self):
+
+        self.db.close()
+
+    def print_stats(self):
+
+        print(f'tag group stats cache: {self.hits} counts reused, {self.stores} counts stored')
@@ -0,0 +1,96 @@
+"""
+compact in-memory index of the Autofocus tag data in data/tagdata.json
+loaded once per process and shared by the sample and session parsers so
+per-page tag enrichment is a dict lookup instead of a full json file parse
+"""
+import sys
+import threading
+from collections import namedtuple
+
+# orjson or stdlib json serialization
+from jsoncodec import load
+
+# tag_groups is None when the tag has no group data
+TagRecord = namedtuple('TagRecord', ['tag_class', 'tag_name', 'tag_groups'])
+
+tag_index = None
+tag_index_lock = threading.Lock()
+
+
+class TagIndex:
+
+    '''
+    public tag name to TagRecord of tag class, tag name, and unique group names
+    '''
+
+    def __init__(self, tag_dict):
+
+        self.records = {}
+
+        for public_name, tag in tag_dict['_tags'].items():
+            tag_class = tag.get('tag_class')
+            if tag_class is not None:
+                tag_class = sys.intern(tag_class)
+
+            tag_name = tag.get('tag_name')
+            if tag_name is not None:
+                tag_name = sys.intern(tag_name)
+
+            if 'tag_groups' in tag:
+                tag_groups = []
+                for group in tag['tag_groups']:
+                    group_name = sys.intern(group['tag_group_name'])
+                    if group_name not in tag_groups:
+                        tag_groups.append(group_name)
+                tag_groups = tuple(tag_groups)
+            else:
+                tag_groups = None
+
+            self.records[sys.intern(public_name)] = TagRecord(tag_class, tag_name, tag_groups)
+
+    @classmethod
+    def from_file(cls, filename='data/tagdata.json'):
+
+        with open(filename, 'r') as tag_file:
+            return cls(load(tag_file))
+
+    def get(self, public_name):
+
+        '''
+        :param public_name: public tag name as listed in the sample or session tag field
+        :return: TagRecord or None if the tag is not in the local tag data
+        '''
+
+        return self.records.get(public_name)
+
+    def __len__(self):
+
+        return len(self.records)
+
+
+def get_tag_index():
+
+    '''
+    return the process-wide tag index, loading data/tagdata.json on first use
+    :return: TagIndex
+    '''
+
+    global tag_index
+
+    with tag_index_lock:
+        if tag_index is None:
+            tag_index = TagIndex.from_file()
+
+    return tag_index
+
+
+def reset_tag_index():
+
+    '''
+    drop the loaded index so the next use reads the refreshed tag data
+    '''
+
+    global tag_index
+
+    with tag_index_lock:
+        tag_index = None